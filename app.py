@@ -1,15 +1,37 @@
-from flask import Flask, request, jsonify
+import time
+STARTUP_STARTED = time.perf_counter()  # Para el reporte de arranque
+
+from flask import Flask, Response, request, jsonify
 import requests
 import json
-import time
+import gzip
+import hashlib
 import re
 import os
 import uuid
+import queue
+import math
+import random
 import logging
-from threading import Thread
+import tracemalloc
+import click
+import fcntl
+from bisect import bisect_left
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from copy import deepcopy
+from types import MappingProxyType
+from threading import Thread, Lock, RLock
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime, timedelta
 
+try:
+    import edge_tts
+except ImportError:  # El audio precalculado es opcional
+    edge_tts = None
+
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.INFO
@@ -17,14 +39,110 @@ logger = logging.INFO
 app = Flask(__name__)
 CORS(app)  # Habilitar CORS para todas las rutas
 
+# Detrás de un proxy, usar X-Forwarded-For para conocer la IP real del cliente
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Reporte de arranque: milisegundos por fase, expuesto en /api/health
+startup_report = {}
+startup_last_mark = STARTUP_STARTED
+
+def mark_startup(phase):
+    """Record how long a startup phase took since the previous mark"""
+    global startup_last_mark
+
+    now = time.perf_counter()
+    startup_report[f"{phase}_ms"] = round((now - startup_last_mark) * 1000, 1)
+    startup_last_mark = now
+
+mark_startup("imports")
+
+# Con gunicorn --preload (ver gunicorn.conf.py) la app se importa en el proceso
+# maestro y los hilos y conexiones de cada worker se inician tras el fork.
+# Importar el módulo no inicia nada: los comandos `flask replay`, `rescore`
+# e `intents` no deben abrir hilos ni llamar a Ollama.
+DEFER_WORKER_START = os.environ.get("EVA_DEFER_WORKER_START") == "1"
+CANNED_AUDIO_ENABLED = edge_tts is not None and os.environ.get("EVA_CANNED_AUDIO") == "1"
+worker_started = False
+worker_start_lock = Lock()
+
 # Lista global para conversaciones
 # Usamos un dict para mantener múltiples sesiones
 conversation_contexts = {}
 
+# Versiones de los datos de solo lectura, usadas para ETag/Last-Modified.
+# `contexts_version` aumenta con cada cambio en cualquier sesión y
+# `session_versions` guarda la versión del último cambio de cada sesión.
+contexts_version = 0
+contexts_updated_at = datetime.now()
+session_versions = {}
+session_updated_at = {}
+versions_lock = Lock()
+# Los contadores anteriores empiezan en 0 en cada proceso: los ETag llevan
+# además este identificador, que se renueva en cada worker (start_worker),
+# para que la versión N de un proceso nunca valide la de otro.
+INSTANCE_ID = uuid.uuid4().hex
+
+# Las respuestas más grandes que esto se comprimen con gzip
+COMPRESS_MIN_SIZE = 1024
+
+# Eventos en vivo para el panel de administración (server-sent events).
+# Cada cliente conectado tiene su propia cola; los últimos eventos se
+# conservan para reenviarlos cuando el navegador reconecta con Last-Event-ID.
+SSE_KEEPALIVE_SECONDS = 15
+SSE_QUEUE_SIZE = 100
+# Cada stream ocupa un hilo del worker mientras está abierto: se limita el
+# número de paneles conectados para que siempre queden hilos para /api/chat
+SSE_MAX_SUBSCRIBERS = int(os.environ.get("EVA_SSE_MAX_SUBSCRIBERS", 2))
+SSE_RETRY_AFTER_SECONDS = 30
+event_subscribers = []
+recent_events = deque(maxlen=200)
+last_event_id = 0
+lead_sessions = set()
+session_stages = {}
+events_lock = RLock()
+
 # Configure according to your Ollama instance
+# (valores por defecto; la configuración vigente está en `current_config`)
 LOCAL_OLLAMA_URL = "http://173.249.8.251:11434"
 MODEL_NAME = "neural-chat:7b"
 
+# Precarga del modelo: Ollama lo mantiene en memoria durante OLLAMA_KEEP_ALIVE
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_WARMUP = os.environ.get("OLLAMA_WARMUP", "1") == "1"
+OLLAMA_WARMUP_TIMEOUT = 120
+ollama_http = requests.Session()  # Conexión reutilizada por worker
+
+# Archivo compartido por todos los workers con la configuración versionada.
+# Cada worker lo revisa cada CONFIG_POLL_SECONDS y cambia a la nueva versión.
+EVA_CONFIG_FILE = os.environ.get("EVA_CONFIG_FILE", "eva_config.json")
+CONFIG_POLL_SECONDS = 2
+
+# Agenda de reuniones: slots de 1 hora en días laborables
+SLOT_HOURS = range(9, 17)
+SLOT_DURATION = timedelta(hours=1)
+SLOT_WINDOW_DAYS = 7  # Ventana por defecto de /api/available_slots
+SLOT_MAX_RANGE_DAYS = 62  # Rango máximo consultable
+DAY_NAMES = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+
+# Índice de reuniones agendadas: lista ordenada de (inicio, fin, session_id).
+# Los intervalos nunca se solapan, así que basta una búsqueda binaria para
+# detectar conflictos. Los slots libres se precalculan por día y solo se
+# recalcula el día afectado por cada reserva.
+# Las reservas se guardan en EVA_BOOKINGS_FILE, compartido por todos los
+# workers: cada reserva se comprueba y se escribe bajo un bloqueo entre
+# procesos, y cada worker recarga su índice cuando el archivo cambia.
+EVA_BOOKINGS_FILE = os.environ.get("EVA_BOOKINGS_FILE", "eva_bookings.json")
+booked_slots = []
+booked_starts = []
+availability_buckets = {}
+bookings_id = uuid.uuid4().hex  # Identifica el archivo de reservas (cambia si se borra)
+bookings_file_state = None
+availability_version = 0
+availability_updated_at = datetime.now()
+availability_lock = Lock()
+
 EVA_CONTEXT = """
 # EVA: ASISTENTE VIRTUAL DE ANTARES INNOVATE
 Eres Eva, asistente virtual de Antares Innovate, empresa colombiana especializada en transformación digital. Eres natural, concisa y eficiente, pero siempre cálida. Tu objetivo: generar oportunidades de negocio.
@@ -70,131 +188,585 @@ Conseguir reuniones con prospectos calificados. No resuelvas problemas técnicos
 RECUERDA: Sé natural y conversacional. No te cortes artificialmente a media respuesta. Habla como lo haría un asistente humano profesional. Termina SIEMPRE con UNA pregunta. Tu misión es AGENDAR REUNIONES, no dar soluciones completas.
 """
 
-def update_conversation_context(user_message, session_id):
-    """Update the conversation context with information from user message"""
+# Palabras clave para detectar industria, necesidades, reuniones y precios.
+# Son parte de la configuración versionada y se pueden cambiar vía /api/config.
+# Las tablas "meeting" y "price" solo se usan con intent_mode "keywords" (ver
+# INTENT_MODES); por defecto la intención la detecta el clasificador.
+DEFAULT_KEYWORDS = {
+    "industries": {
+        "alimentos": ["yogur", "yogurt", "alimento", "comida", "restaurante", "café", "panadería", "gastronomía", "food"],
+        "retail": ["tienda", "comercio", "venta", "producto", "retail", "minorista", "ecommerce", "e-commerce", "tienda online"],
+        "servicios": ["servicio", "consultoría", "asesoría", "profesional", "b2b", "firma"],
+        "tecnología": ["tech", "tecnología", "software", "aplicación", "transformación digital", "desarrollo", "informática", "código", "programación"],
+        "educación": ["educación", "escuela", "academia", "universidad", "colegio", "enseñanza", "aprendizaje", "capacitación", "formación"],
+        "salud": ["salud", "clínica", "hospital", "médico", "medicina", "bienestar", "healthcare", "farmacia", "terapia"],
+        "manufactura": ["fábrica", "producción", "manufactura", "industrial", "planta", "maquinaria"],
+        "finanzas": ["banco", "finanzas", "financiero", "inversión", "contabilidad", "dinero", "crédito", "préstamo"],
+        "inmobiliaria": ["inmobiliaria", "propiedad", "bienes raíces", "construcción", "vivienda", "apartamento", "casa"]
+    },
+    "needs": {
+        "branding": ["logo", "marca", "diseño", "identidad", "imagen", "rebranding", "logotipo"],
+        "web": ["página", "web", "sitio", "online", "tienda online", "e-commerce", "ecommerce", "landing", "website"],
+        "marketing": ["marketing", "publicidad", "campaña", "redes sociales", "ventas", "leads", "conversión"],
+        "app": ["app", "aplicación", "móvil", "celular", "android", "ios", "smartphone"],
+        "automatización": ["automatización", "procesos", "flujo", "chatbot", "bot", "eficiencia", "optimización"]
+    },
+    "meeting": ["reunión", "reunir", "asesoría", "contactar", "llamada", "conocer",
+                "conversar", "hablar", "cita", "agenda", "calendario", "disponibilidad",
+                "horario", "cuándo", "podemos"],
+    "meeting_virtual": ["virtual", "zoom", "teams", "meet", "google", "videollamada", "online"],
+    "meeting_presencial": ["presencial", "oficina", "persona", "físico", "cara"],
+    "price": ["precio", "costo", "tarifa", "cuánto", "cuanto", "inversión", "presupuesto"]
+}
+KEYWORD_GROUPS = ("industries", "needs")
+# Detección de intención (reunión / precio): "model" usa el clasificador
+# entrenado y "keywords" las tablas "meeting" y "price" de arriba. Sin modelo
+# cargado siempre se usan las tablas.
+INTENT_MODES = ("model", "keywords")
+
+# Expresiones de extracción fijas, compiladas una sola vez
+NAME_PATTERNS = [
+    re.compile(r"(?:me llamo|soy|mi nombre es) ([A-Za-záéíóúÁÉÍÓÚñÑ]+)"),
+    re.compile(r"(?:^|\s)([A-Za-záéíóúÁÉÍÓÚñÑ]+) (?:me llamo|es mi nombre)")
+]
+NAME_STOPWORDS = frozenset(["eva", "hola", "bien", "gracias", "ok", "si", "no"])
+BUSINESS_PATTERNS = [
+    re.compile(r"(?:tengo|trabajo en|mi|nuestra) (?:empresa|negocio|compañía|tienda|marca) (?:de|es|se llama) ([^\.,]+)"),
+    re.compile(r"(?:mi|nuestra) (?:empresa|negocio|compañía|tienda|marca) (?:de|es|se llama) ([^\.,]+)")
+]
+EMAIL_PATTERN = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+PHONE_PATTERN = re.compile(r'\b(?:\+?[0-9]{1,3}[-\s]?)?(?:\([0-9]{1,4}\)[-\s]?)?[0-9]{6,10}\b')
+DAYS_PATTERN = re.compile(r'\b(lunes|martes|miércoles|miercoles|jueves|viernes|sábado|sabado|domingo)\b')
+TIME_PATTERN = re.compile(r'\b(([0-9]|1[0-9]|2[0-3])(?::|\.)[0-5][0-9]|([0-9]|1[0-9]|2[0-3]) (?:hrs|horas|h))\b')
+
+# Respuestas fijas de Eva (saludos, respaldos por etapa y preguntas de cierre).
+# Se precalculan al arrancar en la tabla `canned_responses`.
+CANNED_TEXTS = {
+    "greeting_initialize": "¡Hola! Soy Eva de Antares Innovate. ¿En qué puedo ayudarte con automatización, marketing o creatividad?",
+    "greeting_reset": "¡Hola! Soy Eva de Antares Innovate. ¿En qué puedo ayudarte con automatización, marketing o creatividad para tu negocio?",
+    "fallback_initial": "¡Hola! Soy Eva de Antares Innovate. ¿A qué te dedicas y en qué podemos ayudarte con automatización o marketing?",
+    "fallback_exploring": "Me gustaría entender mejor tus necesidades. ¿Qué aspecto de tu negocio quieres potenciar primero?",
+    "fallback_interested": "Cada proyecto es único, por eso necesitaríamos una breve reunión para darte un presupuesto. ¿Te gustaría agendar una llamada gratuita?",
+    "fallback_ready_for_meeting": "Perfecto. Para coordinar la reunión, ¿podrías compartirme tu email o número de WhatsApp?",
+    "fallback_default": "¿En qué área específica de tu negocio podría ayudarte nuestro equipo de Antares?",
+    "fallback_bad_format": "¡Hola! Soy Eva de Antares Innovate. ¿Cómo puedo ayudarte con automatización, marketing o creatividad para tu negocio?",
+    "fallback_connection": "Soy Eva de Antares Innovate. ¿En qué puedo ayudarte con automatización o marketing para tu negocio?",
+    "fallback_retries": "Soy Eva de Antares. ¿Qué tipo de proyecto de automatización o marketing te interesa impulsar?",
+    "question_initial": " ¿En qué puedo ayudarte hoy?",
+    "question_exploring": " ¿Qué aspecto te interesa más?",
+    "question_interested": " ¿Te gustaría agendar una reunión con nuestro equipo?",
+    "question_ready_for_meeting": " ¿Te gustaría agendar una reunión con nuestro equipo?"
+}
+
+# Saludos sin más contenido: en la etapa inicial se responden sin llamar al LLM
+GREETING_PATTERN = re.compile(
+    r"^[\s¡!¿]*(?:hola|holi|buen[oa]s?(?: d[ií]as| tardes| noches)?|saludos|hey|hi|hello|qu[eé] tal)"
+    r"(?:[\s,]+eva)?[\s!¡.,?¿]*$",
+    re.IGNORECASE
+)
+EVA_VOICE = os.environ.get("EVA_VOICE", "es-CO-SalomeNeural")
+
+# Presupuesto de generación: el modelo solo genera lo que se va a mostrar.
+# num_ctx se mantiene fijo (cambiarlo entre peticiones obliga a Ollama a
+# recargar el modelo) y el historial se recorta para que quepa junto a la
+# respuesta.
+REPLY_MAX_CHARS = 160
+CHARS_PER_TOKEN = 3.5  # Aproximación para español
+REPLY_TOKEN_SLACK = 16  # Margen para terminar la frase antes del recorte
+REPLY_MAX_TOKENS = int(REPLY_MAX_CHARS / CHARS_PER_TOKEN) + REPLY_TOKEN_SLACK
+OLLAMA_NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", 4096))
+STOP_SEQUENCES = ["\n\n", "\nUsuario:", "\nUser:", "\nCliente:"]
+# Fin de frase, o una pregunta "¿...?" que sigue a una coma o punto y coma
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[.!?…])\s+|(?<=[,;])\s+(?=¿)")
+# Límites de uso (token buckets en memoria). Se comprueban antes de cualquier
+# extracción o llamada al LLM; las tasas están en mensajes por segundo.
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+# Integraciones de confianza que envían más tráfico (p. ej. el puente de WhatsApp)
+RATE_LIMIT_EXEMPT_IPS = frozenset(ip.strip() for ip in os.environ.get("RATE_LIMIT_EXEMPT_IPS", "").split(",") if ip.strip())
+IP_RATE, IP_BURST = 1.0, 30
+SESSION_RATE, SESSION_BURST = 0.2, 5
+NEW_SESSION_RATE, NEW_SESSION_BURST = 20 / 3600, 10
+# Acciones con su propio presupuesto por IP (una ficha por petición), además
+# de los buckets de sesiones nuevas y de cada sesión. Los mensajes de un batch
+# gastan su propio bucket por IP en lugar del de mensajes, y un batch no puede
+# pedir más de lo que cabe en cada bucket (ver chat_batch).
+ACTION_LIMITS = {
+    "batch": (1 / 10, 3, 'Too many batch requests from this IP'),
+    "meeting": (5 / 3600, 3, 'Too many meeting requests from this IP')
+}
+BATCH_ITEM_RATE, BATCH_ITEM_BURST = 100 / 600, 100
+SESSION_MAX_MESSAGES = 100
+RATE_LIMIT_MAX_KEYS = 100000
+rate_buckets = {}
+# Mensajes aceptados por sesión; /api/reset no los reinicia
+session_message_counts = {}
+rate_limit_stats = {"rejected": 0}
+rate_limit_lock = Lock()
+
+# /api/chat/batch: máximo de mensajes por petición y de llamadas simultáneas al LLM
+BATCH_MAX_ITEMS = BATCH_ITEM_BURST
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", 4))
+generation_stats = {"replies": 0, "trimmed_replies": 0, "prompt_tokens": 0, "tokens_generated": 0, "tokens_kept": 0}
+CannedResponse = namedtuple("CannedResponse", ["text", "json", "audio"])
+canned_stats = {"greeting_hits": 0, "fallback_hits": 0}
+
+ConfigSnapshot = namedtuple("ConfigSnapshot", [
+    "version", "updated_at", "ollama_url", "model_name", "prompt_context",
+    "keywords", "extractors", "prompt_header", "intent_mode", "intent_model"
+])
+
+def compile_keywords(words):
+    """Compile a keyword list into one regex matching keywords at the start of a word"""
+    if not words:
+        return re.compile(r"(?!x)x")  # Nunca coincide
+    # Solo al inicio de palabra: "ios" no debe coincidir con "precios"
+    return re.compile(r"(?<!\w)(?:" + "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True)) + ")")
+
+def compile_extractors(keywords):
+    """Compile every keyword table; grouped tables keep their category order"""
+    extractors = {}
+    for table, words in keywords.items():
+        if table in KEYWORD_GROUPS:
+            extractors[table] = [(category, compile_keywords(group)) for category, group in words.items()]
+        else:
+            extractors[table] = compile_keywords(words)
+    return extractors
+
+def validate_keywords(keywords):
+    """Validate keyword tables sent to /api/config; raises ValueError"""
+    if not isinstance(keywords, dict):
+        raise ValueError("keywords must be an object")
+    for table, words in keywords.items():
+        if table not in DEFAULT_KEYWORDS:
+            raise ValueError(f"Unknown keyword table: {table}")
+        groups = words.values() if table in KEYWORD_GROUPS and isinstance(words, dict) else [words]
+        if table in KEYWORD_GROUPS and not isinstance(words, dict):
+            raise ValueError(f"{table} must map categories to keyword lists")
+        for group in groups:
+            if not isinstance(group, list) or not all(isinstance(word, str) and word for word in group):
+                raise ValueError(f"{table} must contain lists of non-empty strings")
+
+def build_config_snapshot(version, updated_at, ollama_url, model_name, prompt_context, keywords, intent_mode, previous=None, intent_model=None):
+    """Build an immutable configuration snapshot.
+
+    Compiled extractors and the prompt header are reused from `previous`
+    when their inputs did not change. The intent model is loaded from
+    INTENT_MODEL_FILE rather than stored, so it is carried over from
+    `previous` (see reload_intent_model).
+    """
+    if previous:
+        intent_model = previous.intent_model
+    if previous and previous.keywords == keywords:
+        extractors = previous.extractors
+    else:
+        extractors = MappingProxyType(compile_extractors(keywords))
+    if previous and previous.prompt_context == prompt_context:
+        prompt_header = previous.prompt_header
+    else:
+        prompt_header = prompt_context + "\n\n## INFORMACIÓN DEL CLIENTE\n"
+    return ConfigSnapshot(version, updated_at, ollama_url, model_name, prompt_context,
+                          keywords, extractors, prompt_header, intent_mode, intent_model)
+
+def config_to_dict(config):
+    """Serializable form of a snapshot, as stored in EVA_CONFIG_FILE"""
+    return {
+        'version': config.version,
+        'updated_at': config.updated_at.timestamp(),
+        'ollama_url': config.ollama_url,
+        'model_name': config.model_name,
+        'prompt_context': config.prompt_context,
+        'keywords': config.keywords,
+        'intent_mode': config.intent_mode
+    }
+
+def validate_intent_mode(intent_mode):
+    """Validate the intent detection mode sent to /api/config; raises ValueError"""
+    if intent_mode not in INTENT_MODES:
+        raise ValueError(f"intent_mode must be one of: {', '.join(INTENT_MODES)}")
+
+CONFIG_FIELDS = ('ollama_url', 'model_name', 'prompt_context', 'keywords', 'intent_mode')
+
+def validate_config_changes(changes):
+    """Validate configuration fields sent to /api/config or stored in EVA_CONFIG_FILE; raises ValueError"""
+    for field in ('ollama_url', 'model_name', 'prompt_context'):
+        if field in changes and (not isinstance(changes[field], str) or not changes[field].strip()):
+            raise ValueError(f"{field} must be a non-empty string")
+    if 'keywords' in changes:
+        validate_keywords(changes['keywords'])
+    if 'intent_mode' in changes:
+        validate_intent_mode(changes['intent_mode'])
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock shared by every worker process (fcntl.flock on `path`)"""
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_config_file():
+    """Read the shared configuration file; returns None if missing or invalid"""
+    try:
+        with open(EVA_CONFIG_FILE, encoding='utf-8') as config_file:
+            stored = json.load(config_file)
+        if not isinstance(stored, dict):
+            raise ValueError("expected a JSON object")
+        if not isinstance(stored.get('version', 0), int):
+            raise ValueError("version must be an integer")
+        validate_config_changes(stored)
+        return stored
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Configuración inválida en {EVA_CONFIG_FILE}: {str(e)}")
+        return None
+
+def snapshot_from_stored(stored, previous):
+    """Build the snapshot stored in EVA_CONFIG_FILE, filling gaps from `previous`"""
+    return build_config_snapshot(
+        stored['version'],
+        datetime.fromtimestamp(stored.get('updated_at', time.time())),
+        stored.get('ollama_url', previous.ollama_url),
+        stored.get('model_name', previous.model_name),
+        stored.get('prompt_context', previous.prompt_context),
+        {**DEFAULT_KEYWORDS, **stored.get('keywords', {})},
+        stored.get('intent_mode', previous.intent_mode),
+        previous=previous
+    )
+
+def load_config_file(previous):
+    """Swap to the snapshot in EVA_CONFIG_FILE if it is newer than `previous`"""
+    global current_config
+
+    stored = read_config_file()
+    if not stored or stored.get('version', 0) <= previous.version:
+        return False
+    with config_lock:
+        if stored['version'] <= current_config.version:
+            return False
+        current_config = snapshot_from_stored(stored, current_config)
+    print(f"Configuración actualizada a la versión {current_config.version}")
+    return True
+
+def save_config(**changes):
+    """Publish a new configuration version to this worker and to EVA_CONFIG_FILE.
+
+    Runs under a lock shared by every worker and applies `changes` on top of
+    the stored configuration when it is newer than this worker's, so a
+    change published by another worker is never overwritten.
+    """
+    global current_config
+
+    with config_lock, file_lock(f"{EVA_CONFIG_FILE}.lock"):
+        stored = read_config_file()
+        if stored and stored.get('version', 0) > current_config.version:
+            current_config = snapshot_from_stored(stored, current_config)
+        base = current_config
+        keywords = {**base.keywords, **changes.get('keywords', {})}
+        new_config = build_config_snapshot(
+            base.version + 1,
+            datetime.now(),
+            changes.get('ollama_url', base.ollama_url),
+            changes.get('model_name', base.model_name),
+            changes.get('prompt_context', base.prompt_context),
+            keywords,
+            changes.get('intent_mode', base.intent_mode),
+            previous=base
+        )
+        
+        # Escritura atómica para que ningún worker lea un archivo a medias
+        temp_path = f"{EVA_CONFIG_FILE}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as config_file:
+            json.dump(config_to_dict(new_config), config_file, ensure_ascii=False)
+        os.replace(temp_path, EVA_CONFIG_FILE)
+        current_config = new_config
+    return new_config
+
+def file_mtime(path):
+    """Modification time of a file, or None if it does not exist"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def watch_config_file():
+    """Poll EVA_CONFIG_FILE and INTENT_MODEL_FILE and reload them when they change"""
+    last_mtime = None
+    last_model_mtime = file_mtime(INTENT_MODEL_FILE)
+    while True:
+        mtime = file_mtime(EVA_CONFIG_FILE)
+        if mtime is not None and mtime != last_mtime:
+            last_mtime = mtime
+            load_config_file(current_config)
+        model_mtime = file_mtime(INTENT_MODEL_FILE)
+        if model_mtime is not None and model_mtime != last_model_mtime:
+            last_model_mtime = model_mtime
+            reload_intent_model()
+        time.sleep(CONFIG_POLL_SECONDS)
+
+# Clasificador de intención (reunión / precio) para detectar la etapa.
+# Regresión logística uno-contra-resto sobre n-gramas de caracteres. Los pesos
+# se entrenan fuera de línea con `flask intents --save` a partir de
+# INTENT_TRAINING_FILE y se guardan en INTENT_MODEL_FILE, que se carga al
+# arrancar (y de nuevo cuando cambia) como parte de la configuración vigente.
+# Sin ese archivo, o con intent_mode "keywords", se usan las palabras clave.
+INTENT_TRAINING_FILE = os.environ.get("INTENT_TRAINING_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_training.jsonl"))
+INTENT_MODEL_FILE = os.environ.get("INTENT_MODEL_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_model.json"))
+INTENT_LABELS = ("meeting", "price")
+INTENT_NGRAMS = (2, 3, 4)
+INTENT_EPOCHS = 30
+INTENT_LEARNING_RATE = 1.0
+INTENT_L2 = 1e-4
+# Probabilidad mínima para aceptar una intención: un margen sobre 0.5 evita
+# leads falsos en mensajes cortos y ambiguos ("me llamo Juan")
+INTENT_THRESHOLD = 0.6
+INTENT_MARGIN = math.log(INTENT_THRESHOLD / (1 - INTENT_THRESHOLD))
+INTENT_ACCENTS = str.maketrans("áéíóúüàèìòù", "aeiouuaeiou")
+INTENT_CLEAN_PATTERN = re.compile(r"[^a-z0-9@ñ]+")
+IntentModel = namedtuple("IntentModel", ["labels", "weights", "bias", "examples"])
+
+def normalize_intent_text(text):
+    """Lowercase text without accents or punctuation, padded with spaces"""
+    return " " + INTENT_CLEAN_PATTERN.sub(" ", text.lower().translate(INTENT_ACCENTS)).strip() + " "
+
+def intent_ngrams(text):
+    """Set of character n-grams of an already normalized text"""
+    return {text[i:i + n] for n in INTENT_NGRAMS for i in range(len(text) - n + 1)}
+
+def intent_features(text):
+    """Set of character n-grams of the normalized text (no accents or punctuation)"""
+    return intent_ngrams(normalize_intent_text(text))
+
+def load_intent_examples(path):
+    """Load labeled messages: one {"text": ..., "intents": [...]} object per line"""
+    examples = []
+    with open(path, encoding='utf-8') as jsonl_file:
+        for line in jsonl_file:
+            if line.strip():
+                record = json.loads(line)
+                examples.append((record["text"], frozenset(record.get("intents", []))))
+    return examples
+
+def train_intent_model(examples, labels=INTENT_LABELS):
+    """Train one logistic regression per label with SGD over n-gram features"""
+    rng = random.Random(0)
+    weights = {}
+    data = []
+    for text, intents in examples:
+        features = intent_features(text)
+        rows = [weights.setdefault(feature, [0.0] * len(labels)) for feature in features]
+        targets = [float(label in intents) for label in labels]
+        data.append((rows, targets, 1 / math.sqrt(len(features)) if features else 0.0))
+    
+    bias = [0.0] * len(labels)
+    decay = 1 - INTENT_LEARNING_RATE * INTENT_L2
+    for _ in range(INTENT_EPOCHS):
+        rng.shuffle(data)
+        for rows, targets, scale in data:
+            for k, target in enumerate(targets):
+                score = bias[k] + scale * sum(row[k] for row in rows)
+                step = INTENT_LEARNING_RATE * (target - 1 / (1 + math.exp(-max(min(score, 30), -30))))
+                bias[k] += step
+                step *= scale
+                for row in rows:
+                    row[k] = row[k] * decay + step
+    return IntentModel(labels, MappingProxyType({feature: tuple(row) for feature, row in weights.items()}),
+                       tuple(bias), len(examples))
+
+def score_intents(features, rows, model):
+    """Labels whose probability exceeds INTENT_THRESHOLD, given a message's features and weight rows"""
+    if not rows:
+        return {label for label, bias in zip(model.labels, model.bias) if bias > INTENT_MARGIN}
+    scale = 1 / math.sqrt(len(features))
+    # Producto disperso: sumar por columnas las filas de la matriz de pesos
+    scores = [bias + scale * sum(column) for bias, column in zip(model.bias, zip(*rows))]
+    return {label for label, score in zip(model.labels, scores) if score > INTENT_MARGIN}
+
+def classify_intents(text, model):
+    """Labels whose probability is above INTENT_THRESHOLD"""
+    features = intent_features(text)
+    return score_intents(features, [row for row in map(model.weights.get, features) if row], model)
+
+def classify_intents_batch(texts, model):
+    """Classify several messages at once; messages that normalize alike are scored once"""
+    scored = {}
+    results = []
+    for text in texts:
+        normalized = normalize_intent_text(text)
+        intents = scored.get(normalized)
+        if intents is None:
+            features = intent_ngrams(normalized)
+            intents = scored[normalized] = score_intents(features, [row for row in map(model.weights.get, features) if row], model)
+        results.append(set(intents))
+    return results
+
+def rule_intents(text, extractors):
+    """Intents from the keyword tables (fallback when no model is loaded)"""
+    message_lower = text.lower()
+    return {label for label in INTENT_LABELS if extractors[label].search(message_lower)}
+
+def detect_intents(text):
+    """Intents of a message with the current model or, failing that, the keywords"""
+    config = current_config
+    if config.intent_mode == "model" and config.intent_model:
+        return classify_intents(text, config.intent_model)
+    return rule_intents(text, config.extractors)
+
+def detect_intents_batch(texts):
+    """detect_intents for several messages, classified in one batch"""
+    config = current_config
+    if config.intent_mode == "model" and config.intent_model:
+        return classify_intents_batch(texts, config.intent_model)
+    return [rule_intents(text, config.extractors) for text in texts]
+
+def save_intent_model(model, path):
+    """Atomically write a trained model's weight matrix as JSON"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as model_file:
+        json.dump({
+            'labels': model.labels,
+            'ngrams': INTENT_NGRAMS,
+            'examples': model.examples,
+            'bias': [round(bias, 6) for bias in model.bias],
+            'weights': {feature: [round(weight, 6) for weight in row] for feature, row in model.weights.items()}
+        }, model_file, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+def load_intent_model():
+    """Load the precomputed weights in INTENT_MODEL_FILE; None if missing or invalid"""
+    try:
+        with open(INTENT_MODEL_FILE, encoding='utf-8') as model_file:
+            stored = json.load(model_file)
+        if tuple(stored['ngrams']) != INTENT_NGRAMS or tuple(stored['labels']) != INTENT_LABELS:
+            raise ValueError("el modelo se entrenó con otras etiquetas o n-gramas")
+        return IntentModel(INTENT_LABELS, MappingProxyType({feature: tuple(row) for feature, row in stored['weights'].items()}),
+                           tuple(stored['bias']), stored['examples'])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"No se pudo cargar {INTENT_MODEL_FILE}: {str(e)}")
+        return None
+
+def reload_intent_model():
+    """Load INTENT_MODEL_FILE again and swap the model into the current snapshot"""
+    global current_config
+
+    model = load_intent_model()
+    if not model:
+        return False
+    with config_lock:
+        current_config = current_config._replace(intent_model=model)
+    print(f"Modelo de intención actualizado ({model.examples} ejemplos)")
+    return True
+
+config_lock = Lock()
+current_config = build_config_snapshot(0, datetime.now(), LOCAL_OLLAMA_URL, MODEL_NAME, EVA_CONTEXT, DEFAULT_KEYWORDS,
+                                       INTENT_MODES[0], intent_model=load_intent_model())
+mark_startup("intent_model")
+load_config_file(current_config)
+mark_startup("config")
+
+def update_conversation_context(user_message, session_id, intents=None):
+    """Update the conversation context with information from user message.
+
+    `intents` can be precomputed with detect_intents_batch.
+    """
     # Asegúrate de que el contexto de conversación existe para esta sesión
     if session_id not in conversation_contexts:
         initialize_conversation_context(session_id)
     
     context = conversation_contexts[session_id]["user_info"]
+    message_lower = user_message.lower()
     
     # Extract name if not already known
     if not context["name"]:
-        name_patterns = [
-            r"(?:me llamo|soy|mi nombre es) ([A-Za-záéíóúÁÉÍÓÚñÑ]+)",
-            r"(?:^|\s)([A-Za-záéíóúÁÉÍÓÚñÑ]+) (?:me llamo|es mi nombre)"
-        ]
-        for pattern in name_patterns:
-            name_match = re.search(pattern, user_message.lower())
+        for pattern in NAME_PATTERNS:
+            name_match = pattern.search(message_lower)
             if name_match:
                 potential_name = name_match.group(1).strip().capitalize()
                 # Verify it's not "Eva" or other common words
-                if potential_name.lower() not in ["eva", "hola", "bien", "gracias", "ok", "si", "no"]:
+                if potential_name.lower() not in NAME_STOPWORDS:
                     context["name"] = potential_name
                     break
     
     # Extract business information
-    business_patterns = [
-        r"(?:tengo|trabajo en|mi|nuestra) (?:empresa|negocio|compañía|tienda|marca) (?:de|es|se llama) ([^\.,]+)",
-        r"(?:mi|nuestra) (?:empresa|negocio|compañía|tienda|marca) (?:de|es|se llama) ([^\.,]+)"
-    ]
-    for pattern in business_patterns:
-        business_match = re.search(pattern, user_message.lower())
+    for pattern in BUSINESS_PATTERNS:
+        business_match = pattern.search(message_lower)
         if business_match:
             context["business"] = business_match.group(1).strip()
             break
     
     # Improved industry/sector detection
-    industries = {
-        "alimentos": ["yogur", "yogurt", "alimento", "comida", "restaurante", "café", "panadería", "gastronomía", "food"],
-        "retail": ["tienda", "comercio", "venta", "producto", "retail", "minorista", "ecommerce", "e-commerce", "tienda online"],
-        "servicios": ["servicio", "consultoría", "asesoría", "profesional", "b2b", "firma"],
-        "tecnología": ["tech", "tecnología", "software", "aplicación", "digital", "desarrollo", "informática", "código", "programación"],
-        "educación": ["educación", "escuela", "academia", "universidad", "colegio", "enseñanza", "aprendizaje", "capacitación", "formación"],
-        "salud": ["salud", "clínica", "hospital", "médico", "medicina", "bienestar", "healthcare", "farmacia", "terapia"],
-        "manufactura": ["fábrica", "producción", "manufactura", "industrial", "planta", "maquinaria"],
-        "finanzas": ["banco", "finanzas", "financiero", "inversión", "contabilidad", "dinero", "crédito", "préstamo"],
-        "inmobiliaria": ["inmobiliaria", "propiedad", "bienes raíces", "construcción", "vivienda", "apartamento", "casa"]
-    }
-    
-    for industry, keywords in industries.items():
-        if any(keyword in user_message.lower() for keyword in keywords):
+    extractors = current_config.extractors
+    for industry, pattern in extractors["industries"]:
+        if pattern.search(message_lower):
             context["industry"] = industry
             break
     
     # Detect needs and interests (mejorado)
-    need_keywords = {
-        "branding": ["logo", "marca", "diseño", "identidad", "imagen", "rebranding", "logotipo"],
-        "web": ["página", "web", "sitio", "online", "tienda online", "e-commerce", "ecommerce", "landing", "website"],
-        "marketing": ["marketing", "publicidad", "campaña", "redes sociales", "digital", "ventas", "leads", "conversión"],
-        "app": ["app", "aplicación", "móvil", "celular", "android", "ios", "smartphone"],
-        "automatización": ["automatización", "procesos", "flujo", "chatbot", "bot", "eficiencia", "optimización"]
-    }
-    
-    for need, keywords in need_keywords.items():
-        if any(keyword in user_message.lower() for keyword in keywords):
+    for need, pattern in extractors["needs"]:
+        if pattern.search(message_lower):
             if need not in context["needs"]:
                 context["needs"].append(need)
     
     # Detectar información de contacto
-    email_pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-    phone_pattern = r'\b(?:\+?[0-9]{1,3}[-\s]?)?(?:\([0-9]{1,4}\)[-\s]?)?[0-9]{6,10}\b'
-    
-    email_match = re.search(email_pattern, user_message)
+    email_match = EMAIL_PATTERN.search(user_message)
     if email_match and not context["email"]:
         context["email"] = email_match.group(0)
     
-    phone_match = re.search(phone_pattern, user_message)
+    phone_match = PHONE_PATTERN.search(user_message)
     if phone_match and not context["phone"]:
         context["phone"] = phone_match.group(0)
     
     # Detectar deseo de programar una reunión (mejorado)
-    meeting_keywords = ["reunión", "reunir", "asesoría", "contactar", "llamada", "conocer", 
-                        "conversar", "hablar", "cita", "agenda", "calendario", "disponibilidad",
-                        "horario", "cuándo", "podemos"]
-    
-    if any(word in user_message.lower() for word in meeting_keywords):
+    if intents is None:
+        intents = detect_intents(user_message)
+    if "meeting" in intents:
         context["stage"] = "ready_for_meeting"
         context["meeting_interest"] = True
         
         # Detectar preferencia de tipo de reunión
-        if any(word in user_message.lower() for word in ["virtual", "zoom", "teams", "meet", "google", "videollamada", "online"]):
+        if extractors["meeting_virtual"].search(message_lower):
             context["meeting_preference"] = "virtual"
-        elif any(word in user_message.lower() for word in ["presencial", "oficina", "persona", "físico", "cara"]):
+        elif extractors["meeting_presencial"].search(message_lower):
             context["meeting_preference"] = "presencial"
             
         # Detectar fechas o días mencionados
-        days_pattern = r'\b(lunes|martes|miércoles|miercoles|jueves|viernes|sábado|sabado|domingo)\b'
-        days_match = re.search(days_pattern, user_message.lower())
+        days_match = DAYS_PATTERN.search(message_lower)
         if days_match:
             context["preferred_day"] = days_match.group(0)
         
         # Detectar horas mencionadas
-        time_pattern = r'\b(([0-9]|1[0-9]|2[0-3])(?::|\.)[0-5][0-9]|([0-9]|1[0-9]|2[0-3]) (?:hrs|horas|h))\b'
-        time_match = re.search(time_pattern, user_message.lower())
+        time_match = TIME_PATTERN.search(message_lower)
         if time_match:
             context["preferred_time"] = time_match.group(0)
     
     # Actualizar etapa de conversación
-    if any(word in user_message.lower() for word in ["precio", "costo", "tarifa", "cuánto", "cuanto", "inversión", "presupuesto"]):
+    if "price" in intents:
         context["stage"] = "interested"
         context["price_asked"] = True
     elif len(context["needs"]) > 0:
         context["stage"] = "exploring"
 
-def create_custom_prompt(user_message, session_id):
+def create_custom_prompt(user_message, session_id, intents=None):
     """Create a custom prompt for Ollama based on conversation context"""
     # Asegúrate de que el contexto de conversación existe para esta sesión
     if session_id not in conversation_contexts:
         initialize_conversation_context(session_id)
     
-    context = conversation_contexts[session_id]["user_info"]
-    
     # Update context with current message information
-    update_conversation_context(user_message, session_id)
+    update_conversation_context(user_message, session_id, intents)
+    
+    return build_custom_prompt(session_id)
+
+def build_custom_prompt(session_id):
+    """Render the system prompt from the session's current context"""
+    context = conversation_contexts[session_id]["user_info"]
     
     # Create a personalized system message with user context
-    custom_instructions = EVA_CONTEXT + "\n\n## INFORMACIÓN DEL CLIENTE\n"
+    custom_instructions = current_config.prompt_header
     
     if context["name"]:
         custom_instructions += f"- Nombre: {context['name']}\n"
@@ -271,29 +843,46 @@ def create_custom_prompt(user_message, session_id):
     
     return custom_instructions
 
-def call_ollama_api(prompt, session_id, max_retries=3):
+def call_ollama_api(prompt, session_id, max_retries=3, intents=None):
     """Calls Ollama API (chat endpoint) with retries"""
-    global LOCAL_OLLAMA_URL, MODEL_NAME
-    
+    canned_reply, data = prepare_ollama_request(prompt, session_id, intents)
+    if canned_reply is not None:
+        return canned_reply
+    return send_ollama_request(data, session_id, max_retries)
+
+def prepare_ollama_request(prompt, session_id, intents=None):
+    """Run extraction for a message and build its Ollama chat request.
+
+    Returns (reply, None) when the message is answered without the LLM,
+    otherwise (None, data) with the request body for send_ollama_request.
+    """
     # Asegúrate de que el contexto de conversación existe para esta sesión
     if session_id not in conversation_contexts:
         initialize_conversation_context(session_id)
     
-    headers = {
-        "Content-Type": "application/json"
-    }
-    
-    # Create custom instructions based on conversation context
-    system_message = create_custom_prompt(prompt, session_id)
+    # Saludo simple en la etapa inicial: responder sin pasar por el LLM
+    if conversation_contexts[session_id]["user_info"]["stage"] == "initial" and GREETING_PATTERN.match(prompt):
+        update_conversation_context(prompt, session_id, intents)
+        if conversation_contexts[session_id]["user_info"]["stage"] == "initial":
+            canned_stats["greeting_hits"] += 1
+            content = canned_responses["fallback_initial"].text
+            conversation_contexts[session_id]["messages"].append({"role": "user", "content": prompt})
+            conversation_contexts[session_id]["messages"].append({"role": "assistant", "content": content})
+            return content, None
+        # El mensaje ya pasó por la extracción: solo falta generar el prompt
+        system_message = build_custom_prompt(session_id)
+    else:
+        # Create custom instructions based on conversation context
+        system_message = create_custom_prompt(prompt, session_id, intents)
     
     # Prepare messages for chat API format
     messages = [
         {"role": "system", "content": system_message}
     ]
     
-    # Add conversation history (use all messages for continuity)
-    for message in conversation_contexts[session_id]["messages"]:
-        messages.append(message)
+    # Add conversation history (as much as fits in the context window)
+    history_budget = OLLAMA_NUM_CTX - REPLY_MAX_TOKENS - estimate_tokens(system_message) - estimate_tokens(prompt)
+    messages.extend(fit_history(conversation_contexts[session_id]["messages"], history_budget))
     
     # Add new user message
     messages.append({"role": "user", "content": prompt})
@@ -303,19 +892,31 @@ def call_ollama_api(prompt, session_id, max_retries=3):
     
     # Prepare data for API
     data = {
-        "model": MODEL_NAME,
+        "model": current_config.model_name,
         "messages": messages,
         "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {
-            "temperature": 0.7
+            "temperature": 0.7,
+            "num_predict": REPLY_MAX_TOKENS,
+            "num_ctx": OLLAMA_NUM_CTX,
+            "stop": STOP_SEQUENCES
         }
     }
+    return None, data
+
+def send_ollama_request(data, session_id, max_retries=3):
+    """Send a prepared chat request to Ollama with retries and post-process the reply"""
+    headers = {
+        "Content-Type": "application/json"
+    }
     
     # Try with retries
     for attempt in range(max_retries):
         try:
-            print(f"Conectando a {LOCAL_OLLAMA_URL}...")
-            response = requests.post(LOCAL_OLLAMA_URL, headers=headers, json=data, timeout=30)
+            ollama_url = current_config.ollama_url
+            print(f"Conectando a {ollama_url}...")
+            response = ollama_http.post(ollama_url, headers=headers, json=data, timeout=30)
             
             # Print response details for debugging
             print(f"Código de estado: {response.status_code}")
@@ -326,22 +927,13 @@ def call_ollama_api(prompt, session_id, max_retries=3):
             # Extract response according to chat API format
             if "message" in response_data and "content" in response_data["message"]:
                 content = response_data["message"]["content"].strip()
+                generated = content
                 
                 # Check if content is empty, try a fallback
                 if not content:
                     print("Respuesta vacía, intentando con un prompt diferente...")
                     # Use fallback based on conversation stage
-                    stage = conversation_contexts[session_id]["user_info"]["stage"]
-                    if stage == "initial":
-                        content = "¡Hola! Soy Eva de Antares Innovate. ¿A qué te dedicas y en qué podemos ayudarte con automatización o marketing?"
-                    elif stage == "exploring":
-                        content = "Me gustaría entender mejor tus necesidades. ¿Qué aspecto de tu negocio quieres potenciar primero?"
-                    elif stage == "interested":
-                        content = "Cada proyecto es único, por eso necesitaríamos una breve reunión para darte un presupuesto. ¿Te gustaría agendar una llamada gratuita?"
-                    elif stage == "ready_for_meeting":
-                        content = "Perfecto. Para coordinar la reunión, ¿podrías compartirme tu email o número de WhatsApp?"
-                    else:
-                        content = "¿En qué área específica de tu negocio podría ayudarte nuestro equipo de Antares?"
+                    content = canned_fallback(conversation_contexts[session_id]["user_info"]["stage"])
                 
                 # Ensure response ends with a question (if it doesn't already)
                 if not content.endswith("?"):
@@ -349,16 +941,13 @@ def call_ollama_api(prompt, session_id, max_retries=3):
                     if "?" not in content:
                         # Add a contextual question based on conversation stage
                         stage = conversation_contexts[session_id]["user_info"]["stage"]
-                        if stage == "initial":
-                            content += " ¿En qué puedo ayudarte hoy?"
-                        elif stage == "exploring":
-                            content += " ¿Qué aspecto te interesa más?"
-                        elif stage == "interested" or stage == "ready_for_meeting":
-                            content += " ¿Te gustaría agendar una reunión con nuestro equipo?"
+                        question = canned_responses.get(f"question_{stage}")
+                        if question:
+                            content += question.text
                 
                 # Ensure response is not too long (max 160 characters)
-                if len(content) > 160:
-                    content = content[:157] + "..."
+                content = trim_reply(content)
+                record_generation(response_data, generated, content)
                 
                 # Save assistant response to history
                 conversation_contexts[session_id]["messages"].append({"role": "assistant", "content": content})
@@ -366,7 +955,7 @@ def call_ollama_api(prompt, session_id, max_retries=3):
                 return content
             else:
                 print(f"Formato de respuesta inesperado: {response_data}")
-                fallback_response = "¡Hola! Soy Eva de Antares Innovate. ¿Cómo puedo ayudarte con automatización, marketing o creatividad para tu negocio?"
+                fallback_response = canned_responses["fallback_bad_format"].text
                 # Save fallback response to history
                 conversation_contexts[session_id]["messages"].append({"role": "assistant", "content": fallback_response})
                 return fallback_response
@@ -378,37 +967,498 @@ def call_ollama_api(prompt, session_id, max_retries=3):
                 print(f"Reintentando en {wait_time} segundos...")
                 time.sleep(wait_time)
             else:
-                fallback_response = "Soy Eva de Antares Innovate. ¿En qué puedo ayudarte con automatización o marketing para tu negocio?"
+                fallback_response = canned_responses["fallback_connection"].text
                 # Save fallback response to history
                 conversation_contexts[session_id]["messages"].append({"role": "assistant", "content": fallback_response})
                 return fallback_response
     
-    fallback_response = "Soy Eva de Antares. ¿Qué tipo de proyecto de automatización o marketing te interesa impulsar?"
+    fallback_response = canned_responses["fallback_retries"].text
     # Save fallback response to history
     conversation_contexts[session_id]["messages"].append({"role": "assistant", "content": fallback_response})
     return fallback_response
 
+def new_user_info():
+    """Return the user_info of a brand new session"""
+    return {
+        "name": None,
+        "business": None,
+        "industry": None,
+        "email": None,
+        "phone": None,
+        "needs": [],
+        "interests": [],
+        "meeting_interest": False,
+        "meeting_preference": None,
+        "preferred_day": None,
+        "preferred_time": None,
+        "price_asked": False,
+        "stage": "initial"  # initial, exploring, interested, ready_for_meeting
+    }
+
+def estimate_tokens(text):
+    """Rough token count used to budget the context window"""
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+def fit_history(history, budget_tokens):
+    """Return the most recent messages that fit in the token budget"""
+    kept = []
+    for message in reversed(history):
+        budget_tokens -= estimate_tokens(message["content"])
+        if budget_tokens < 0:
+            break
+        kept.append(message)
+    kept.reverse()
+    return kept
+
+def trim_reply(content, max_chars=REPLY_MAX_CHARS):
+    """Trim a reply to max_chars at sentence boundaries, keeping the closing question"""
+    if len(content) <= max_chars:
+        return content
+    
+    sentences = SENTENCE_SPLIT_PATTERN.split(content)
+    question_index = None
+    for index in range(len(sentences) - 1, -1, -1):
+        if sentences[index].endswith("?"):
+            question_index = index
+            break
+    
+    kept = []
+    budget = max_chars
+    if question_index is not None and len(sentences[question_index]) <= max_chars:
+        budget -= len(sentences[question_index])
+        candidates = sentences[:question_index]
+    else:
+        question_index = None
+        candidates = sentences
+    
+    for sentence in candidates:
+        needed = len(sentence) + (1 if kept or question_index is not None else 0)
+        if needed > budget:
+            break
+        kept.append(sentence)
+        budget -= needed
+    
+    if question_index is not None:
+        question = sentences[question_index]
+        # Pregunta separada de su frase por una coma: empieza con mayúscula si queda sola
+        if question.startswith("¿") and not (kept and kept[-1].endswith((",", ";"))):
+            question = question[:2].upper() + question[2:]
+        kept.append(question)
+    if kept:
+        reply = " ".join(kept)
+        return reply if reply[-1] not in ",;" else reply[:-1] + "..."
+    
+    # Ni una frase completa cabe: cortar en el último espacio
+    cut = content[:max_chars - 3].rsplit(" ", 1)[0]
+    return cut.rstrip(",;:") + "..."
+
+def record_generation(response_data, generated, kept):
+    """Accumulate prompt/generated/kept token counters reported by Ollama"""
+    tokens_generated = response_data.get("eval_count") or estimate_tokens(generated)
+    generation_stats["replies"] += 1
+    generation_stats["prompt_tokens"] += response_data.get("prompt_eval_count") or 0
+    generation_stats["tokens_generated"] += tokens_generated
+    if generated and len(kept) < len(generated):
+        generation_stats["trimmed_replies"] += 1
+        generation_stats["tokens_kept"] += round(tokens_generated * len(kept) / len(generated))
+    else:
+        generation_stats["tokens_kept"] += tokens_generated
+
 def initialize_conversation_context(session_id):
     """Initialize a new conversation context for a session"""
     conversation_contexts[session_id] = {
         "messages": [],
-        "user_info": {
-            "name": None,
-            "business": None,
-            "industry": None,
-            "email": None,
-            "phone": None,
-            "needs": [],
-            "interests": [],
-            "meeting_interest": False,
-            "meeting_preference": None,
-            "preferred_day": None,
-            "preferred_time": None,
-            "price_asked": False,
-            "stage": "initial"  # initial, exploring, interested, ready_for_meeting
-        }
+        "user_info": new_user_info()
+    }
+
+def build_canned_responses(audio=None):
+    """Build the immutable table of canned responses (text, JSON string, audio)"""
+    audio = audio or {}
+    return MappingProxyType({
+        key: CannedResponse(text, json.dumps(text), audio.get(key))
+        for key, text in CANNED_TEXTS.items()
+    })
+
+def synthesize_canned_audio():
+    """Pre-synthesize the canned responses with edge-tts and swap in a new table"""
+    global canned_responses
+    import asyncio
+
+    async def synthesize(text):
+        chunks = []
+        async for chunk in edge_tts.Communicate(text.strip(), EVA_VOICE).stream():
+            if chunk["type"] == "audio":
+                chunks.append(chunk["data"])
+        return b"".join(chunks)
+
+    audio = {}
+    for key, text in CANNED_TEXTS.items():
+        try:
+            audio[key] = asyncio.run(synthesize(text))
+        except Exception as e:
+            print(f"No se pudo sintetizar el audio de '{key}': {str(e)}")
+    canned_responses = build_canned_responses(audio)
+    print(f"Audio precalculado para {len(audio)} respuestas fijas")
+
+def canned_fallback(stage):
+    """Stage-based fallback used when the model returns an empty answer"""
+    canned_stats["fallback_hits"] += 1
+    return canned_responses.get(f"fallback_{stage}", canned_responses["fallback_default"]).text
+
+def canned_session_response(key, session_id):
+    """Response for a fresh session, spliced from pre-serialized JSON fragments"""
+    canned = canned_responses[key]
+    body = "{"
+    if canned.audio:
+        body += f'"audio_url": "/api/canned_audio/{key}", '
+    body += f'"context": {INITIAL_CONTEXT_JSON}, "message": {canned.json}, "session_id": {json.dumps(session_id)}}}\n'
+    return app.response_class(body, mimetype='application/json')
+
+# Fase de arranque: tabla de respuestas fijas y contexto inicial serializado
+INITIAL_CONTEXT_JSON = json.dumps(new_user_info(), sort_keys=True)
+canned_responses = build_canned_responses()
+if CANNED_AUDIO_ENABLED and DEFER_WORKER_START:
+    synthesize_canned_audio()  # En el maestro: los workers heredan el audio
+mark_startup("canned_responses")
+
+def slot_conflicts(start, end):
+    """Check in O(log n) whether [start, end) overlaps an already booked slot"""
+    index = bisect_left(booked_starts, end)
+    # Solo el intervalo que empieza justo antes de `end` puede solaparse
+    return index > 0 and booked_slots[index - 1][1] > start
+
+def build_day_slots(day):
+    """Build the list of free slots for a single date"""
+    slots = []
+    if day.weekday() >= 5:  # 5=Sábado, 6=Domingo
+        return slots
+
+    date_str = day.strftime('%Y-%m-%d')
+    day_name = DAY_NAMES[day.weekday()]
+    for hour in SLOT_HOURS:
+        start = datetime(day.year, day.month, day.day, hour)
+        if slot_conflicts(start, start + SLOT_DURATION):
+            continue
+        slots.append({
+            'date': date_str,
+            'day': day_name,
+            'time': f"{hour}:00",
+            'end_time': f"{hour+1}:00",
+            'available': True
+        })
+    return slots
+
+def get_available_slots(start_day, end_day):
+    """Return free slots between two dates (inclusive) using the day buckets"""
+    today = datetime.now().date()
+    slots = []
+    with availability_lock:
+        # Descartar buckets de días que ya pasaron
+        for day in [d for d in availability_buckets if d < today]:
+            del availability_buckets[day]
+
+        day = max(start_day, today + timedelta(days=1))
+        while day <= end_day:
+            if day not in availability_buckets:
+                availability_buckets[day] = build_day_slots(day)
+            slots.extend(availability_buckets[day])
+            day += timedelta(days=1)
+    return slots
+
+def parse_slot_start(preferred_date, preferred_time):
+    """Parse a date ('YYYY-MM-DD') and time ('H:MM') into a bookable slot start.
+
+    Returns None when the values are free text (e.g. "lunes") or do not match
+    an offered slot, in which case they are kept only as preferences.
+    """
+    if not preferred_date or not preferred_time:
+        return None
+    try:
+        start = datetime.strptime(f"{preferred_date} {preferred_time}", '%Y-%m-%d %H:%M')
+    except (TypeError, ValueError):
+        return None
+    if start.weekday() >= 5 or start.hour not in SLOT_HOURS or start.minute != 0:
+        return None
+    if start.date() <= datetime.now().date():
+        return None
+    return start
+
+def read_bookings_file():
+    """Read EVA_BOOKINGS_FILE as (id, version, [(start, session_id), ...]); None if missing or invalid"""
+    try:
+        with open(EVA_BOOKINGS_FILE, encoding='utf-8') as bookings_file:
+            stored = json.load(bookings_file)
+        bookings = [(datetime.fromisoformat(booking['start']), booking['session_id']) for booking in stored['bookings']]
+        return stored['id'], stored['version'], bookings
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Reservas inválidas en {EVA_BOOKINGS_FILE}: {str(e)}")
+        return None
+
+def load_bookings(stored):
+    """Replace this worker's index with the stored bookings (caller holds availability_lock)"""
+    global bookings_id, availability_version, availability_updated_at
+
+    if not stored or stored[:2] == (bookings_id, availability_version):
+        return
+    bookings_id, availability_version, bookings = stored
+    now = datetime.now()
+    booked_slots[:] = sorted((start, start + SLOT_DURATION, session_id) for start, session_id in bookings if start + SLOT_DURATION > now)
+    booked_starts[:] = [slot[0] for slot in booked_slots]
+    availability_buckets.clear()
+    availability_updated_at = now
+
+def bookings_file_changed():
+    """Record the state of EVA_BOOKINGS_FILE and tell whether it changed since the last call"""
+    global bookings_file_state
+
+    try:
+        stat = os.stat(EVA_BOOKINGS_FILE)
+        state = (stat.st_ino, stat.st_mtime_ns)
+    except OSError:
+        state = None
+    changed = state != bookings_file_state
+    bookings_file_state = state
+    return changed
+
+def refresh_bookings():
+    """Reload the index if another worker changed EVA_BOOKINGS_FILE"""
+    with availability_lock:
+        if bookings_file_changed():
+            load_bookings(read_bookings_file())
+
+def write_bookings_file():
+    """Atomically write this worker's index to EVA_BOOKINGS_FILE (caller holds both locks)"""
+    temp_path = f"{EVA_BOOKINGS_FILE}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as bookings_file:
+        json.dump({
+            'id': bookings_id,
+            'version': availability_version,
+            'bookings': [{'start': start.isoformat(), 'session_id': session_id} for start, _, session_id in booked_slots]
+        }, bookings_file, ensure_ascii=False)
+    os.replace(temp_path, EVA_BOOKINGS_FILE)
+    bookings_file_changed()
+
+def book_slot(start, session_id):
+    """Book a slot for a session, releasing the session's previous booking.
+
+    Returns False if another session already holds the slot. Booking the
+    same slot again is a no-op. The check and the write run under a lock
+    shared by every worker, against the current contents of EVA_BOOKINGS_FILE.
+    """
+    global availability_version, availability_updated_at
+
+    end = start + SLOT_DURATION
+    with availability_lock, file_lock(f"{EVA_BOOKINGS_FILE}.lock"):
+        load_bookings(read_bookings_file())
+        index = bisect_left(booked_starts, start)
+        if index < len(booked_slots) and booked_slots[index][0] == start and booked_slots[index][2] == session_id:
+            return True
+        if slot_conflicts(start, end):
+            return False
+        
+        # Quitar la reserva anterior de la sesión y las que ya pasaron
+        now = datetime.now()
+        changed_days = {start.date()}
+        kept = []
+        for slot in booked_slots:
+            if slot[2] == session_id or slot[1] <= now:
+                changed_days.add(slot[0].date())
+            else:
+                kept.append(slot)
+        kept.insert(bisect_left([slot[0] for slot in kept], start), (start, end, session_id))
+        booked_slots[:] = kept
+        booked_starts[:] = [slot[0] for slot in kept]
+        
+        # Recalcular solo los días afectados
+        for day in changed_days:
+            availability_buckets.pop(day, None)
+        availability_version += 1
+        availability_updated_at = now
+        write_bookings_file()
+    return True
+
+# Fase de arranque: cargar las reservas guardadas
+refresh_bookings()
+mark_startup("bookings")
+
+def mark_session_changed(session_id):
+    """Bump the versions used to validate cached session and lead data"""
+    global contexts_version, contexts_updated_at
+
+    with versions_lock:
+        contexts_version += 1
+        contexts_updated_at = datetime.now()
+        session_versions[session_id] = contexts_version
+        session_updated_at[session_id] = contexts_updated_at
+
+    publish_session_changes(session_id)
+
+def build_lead(session_id, user_info):
+    """Build the lead record exposed to the CRM and the admin dashboard"""
+    return {
+        'session_id': session_id,
+        'name': user_info["name"] or "Desconocido",
+        'email': user_info["email"] or None,
+        'phone': user_info["phone"] or None,
+        'business': user_info["business"] or None,
+        'industry': user_info["industry"] or None,
+        'needs': user_info["needs"],
+        'meeting_preference': user_info["meeting_preference"] or "No especificado",
+        'preferred_day': user_info["preferred_day"] or None,
+        'preferred_time': user_info["preferred_time"] or None,
+        'last_interaction': session_updated_at.get(session_id, contexts_updated_at).strftime('%Y-%m-%d %H:%M:%S'),
+        'complete_info': bool(user_info["email"] or user_info["phone"])
     }
 
+def is_lead(user_info):
+    """Solo se consideran leads quienes han mostrado interés en una reunión"""
+    return user_info["stage"] == "ready_for_meeting" or user_info["meeting_interest"]
+
+def get_stats():
+    """Real session and lead counters for the dashboard"""
+    return {'sessions': len(conversation_contexts), 'leads': len(lead_sessions)}
+
+def publish_event(event_type, data):
+    """Queue an event for every connected dashboard"""
+    global last_event_id
+
+    with events_lock:
+        last_event_id += 1
+        event = (last_event_id, event_type, json.dumps(data, ensure_ascii=False))
+        recent_events.append(event)
+        for subscriber in list(event_subscribers):
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Cliente demasiado lento: se desconecta y recargará al reconectar
+                event_subscribers.remove(subscriber)
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                subscriber.put_nowait(None)
+
+def publish_session_changes(session_id):
+    """Compare a session with its last known state and publish what changed"""
+    user_info = conversation_contexts[session_id]["user_info"]
+    with events_lock:
+        new_session = session_id not in session_stages
+        previous_stage = session_stages.get(session_id)
+        session_stages[session_id] = user_info["stage"]
+        was_lead = session_id in lead_sessions
+
+        if previous_stage is not None and previous_stage != user_info["stage"]:
+            publish_event('stage', {'session_id': session_id, 'from': previous_stage, 'to': user_info["stage"]})
+
+        if is_lead(user_info):
+            lead_sessions.add(session_id)
+            publish_event('lead', {'lead': build_lead(session_id, user_info), 'new': not was_lead})
+        elif was_lead:
+            lead_sessions.discard(session_id)
+            publish_event('lead_removed', {'session_id': session_id})
+
+        if new_session or was_lead != (session_id in lead_sessions):
+            publish_event('stats', get_stats())
+
+def format_sse(event):
+    """Serialize an (id, type, data) event in text/event-stream format"""
+    event_id, event_type, data = event
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
+
+def not_modified(etag):
+    """Return a 304 response if the client already has this version, else None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def cacheable(response, etag, last_modified=None):
+    """Attach validators to a response so clients can revalidate with 304s"""
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def prune_rate_buckets(now):
+    """Drop buckets that have refilled completely (or the oldest half if still too many)"""
+    limits = {"ip": (IP_RATE, IP_BURST), "session": (SESSION_RATE, SESSION_BURST), "new_sessions": (NEW_SESSION_RATE, NEW_SESSION_BURST),
+              "batch_items": (BATCH_ITEM_RATE, BATCH_ITEM_BURST)}
+    limits.update({action: (rate, burst) for action, (rate, burst, _) in ACTION_LIMITS.items()})
+    for key, (tokens, updated) in list(rate_buckets.items()):
+        rate, burst = limits[key[0]]
+        if tokens + (now - updated) * rate >= burst:
+            del rate_buckets[key]
+    if len(rate_buckets) > RATE_LIMIT_MAX_KEYS:
+        oldest = sorted(rate_buckets, key=lambda key: rate_buckets[key][1])
+        for key in oldest[:len(oldest) // 2]:
+            del rate_buckets[key]
+
+def check_rate_limit(message_counts, action=None):
+    """Apply the per-IP and per-session limits to the current request.
+
+    `message_counts` maps each session in the request to the number of
+    messages it sends. With an `action` from ACTION_LIMITS the request is
+    also charged one token from that action's per-IP bucket, and batch
+    messages are charged to the per-IP batch item bucket instead of the
+    message bucket. Returns a 429 response if a limit is exceeded,
+    otherwise consumes the tokens and returns None.
+    """
+    if not RATE_LIMIT_ENABLED:
+        return None
+    ip = request.remote_addr or "unknown"
+    if ip in RATE_LIMIT_EXEMPT_IPS:
+        return None
+    
+    now = time.monotonic()
+    total = sum(message_counts.values())
+    new_sessions = sum(1 for session_id in message_counts if session_id not in conversation_contexts)
+    checks = []
+    if action:
+        rate, burst, error = ACTION_LIMITS[action]
+        checks.append(((action, ip), rate, burst, 1, error))
+    if total and action == "batch":
+        checks.append((("batch_items", ip), BATCH_ITEM_RATE, BATCH_ITEM_BURST, total, 'Too many batch messages from this IP'))
+    elif total:
+        checks.append((("ip", ip), IP_RATE, IP_BURST, total, 'Too many messages from this IP'))
+    if new_sessions:
+        checks.append((("new_sessions", ip), NEW_SESSION_RATE, NEW_SESSION_BURST, new_sessions, 'Too many new sessions from this IP'))
+    
+    with rate_limit_lock:
+        if len(rate_buckets) > RATE_LIMIT_MAX_KEYS:
+            prune_rate_buckets(now)
+        
+        for session_id, count in message_counts.items():
+            if not count:
+                continue
+            if session_message_counts.get(session_id, 0) + count > SESSION_MAX_MESSAGES:
+                rate_limit_stats["rejected"] += 1
+                return jsonify({'error': f'Session message limit reached (max {SESSION_MAX_MESSAGES})'}), 429
+            checks.append((("session", session_id), SESSION_RATE, SESSION_BURST, count, 'Too many messages for this session'))
+        
+        # Comprobar todos los buckets antes de consumir ninguno
+        refilled = []
+        for key, rate, burst, cost, error in checks:
+            tokens, updated = rate_buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < cost:
+                rate_limit_stats["rejected"] += 1
+                headers = {}
+                if cost <= burst:
+                    headers['Retry-After'] = str(math.ceil((cost - tokens) / rate))
+                return jsonify({'error': error}), 429, headers
+            refilled.append((key, tokens - cost))
+        for key, tokens in refilled:
+            rate_buckets[key] = (tokens, now)
+        for session_id, count in message_counts.items():
+            if count:
+                session_message_counts[session_id] = session_message_counts.get(session_id, 0) + count
+    return None
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     """API endpoint to get a response from Eva"""
@@ -422,8 +1472,13 @@ def chat():
         session_id = data.get('session_id', str(uuid.uuid4()))
         user_message = data['message']
         
+        limited = check_rate_limit({session_id: 1})
+        if limited:
+            return limited
+        
         # Get response from Ollama
         response = call_ollama_api(user_message, session_id)
+        mark_session_changed(session_id)
         
         result = {
             'session_id': session_id,
@@ -437,6 +1492,106 @@ def chat():
         print(f"Error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    """Responder varios mensajes independientes en una sola petición.
+
+    Recibe {"items": [{"session_id": ..., "message": ...}, ...]} y devuelve los
+    resultados en el mismo orden. Con "stream": true responde en NDJSON, una
+    línea por mensaje (con su "index") a medida que terminan.
+    """
+    try:
+        data = request.json
+        
+        if not data or not isinstance(data.get('items'), list):
+            return jsonify({'error': 'No items provided'}), 400
+        items = data['items']
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'Too many items (max {BATCH_MAX_ITEMS})'}), 400
+        
+        results = queue.Queue()
+        
+        # Agrupar por sesión: los mensajes de una misma sesión se procesan en orden
+        chains = {}
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get('message'):
+                results.put({'index': index, 'error': 'No message provided'})
+                continue
+            if not isinstance(item['message'], str):
+                results.put({'index': index, 'error': 'message must be a string'})
+                continue
+            if not isinstance(item.get('session_id') or "", str):
+                results.put({'index': index, 'error': 'session_id must be a string'})
+                continue
+            session_id = item.get('session_id') or str(uuid.uuid4())
+            chains.setdefault(session_id, []).append((index, item['message']))
+        
+        for session_id, chain in chains.items():
+            if len(chain) > SESSION_BURST:
+                return jsonify({'error': f'Too many messages for session {session_id} (max {SESSION_BURST} per batch)'}), 400
+        if sum(1 for session_id in chains if session_id not in conversation_contexts) > NEW_SESSION_BURST:
+            return jsonify({'error': f'Too many new sessions (max {NEW_SESSION_BURST} per batch)'}), 400
+        
+        limited = check_rate_limit({session_id: len(chain) for session_id, chain in chains.items()}, action="batch")
+        if limited:
+            return limited
+        
+        # La intención no depende del contexto: se clasifican todos los mensajes en un lote
+        indexed = [(index, message) for chain in chains.values() for index, message in chain]
+        intents = dict(zip((index for index, _ in indexed), detect_intents_batch([message for _, message in indexed])))
+        
+        # Primera pasada: extracción y prompts del primer mensaje de cada sesión.
+        # Un error solo afecta a ese mensaje; se reporta en su resultado.
+        prepared = {}
+        for session_id, chain in chains.items():
+            try:
+                prepared[session_id] = prepare_ollama_request(chain[0][1], session_id, intents[chain[0][0]])
+            except Exception as e:
+                prepared[session_id] = e
+        
+        def run_chain(session_id, chain):
+            for position, (index, message) in enumerate(chain):
+                try:
+                    if position == 0:
+                        if isinstance(prepared[session_id], Exception):
+                            raise prepared[session_id]
+                        canned_reply, request_data = prepared[session_id]
+                        response = canned_reply if canned_reply is not None else send_ollama_request(request_data, session_id)
+                    else:
+                        response = call_ollama_api(message, session_id, intents=intents[index])
+                    mark_session_changed(session_id)
+                    results.put({
+                        'index': index,
+                        'session_id': session_id,
+                        'message': response,
+                        'context': deepcopy(conversation_contexts[session_id]["user_info"])
+                    })
+                except Exception as e:
+                    print(f"Error en batch ({session_id}): {str(e)}")
+                    results.put({'index': index, 'session_id': session_id, 'error': str(e)})
+        
+        # Segunda pasada: llamadas al LLM en paralelo con un límite de concurrencia
+        executor = ThreadPoolExecutor(max_workers=max(1, min(BATCH_MAX_CONCURRENCY, len(chains))))
+        for session_id, chain in chains.items():
+            executor.submit(run_chain, session_id, chain)
+        executor.shutdown(wait=False)
+        
+        if data.get('stream'):
+            def stream():
+                for _ in range(len(items)):
+                    yield json.dumps(results.get(), ensure_ascii=False) + "\n"
+            return Response(stream(), mimetype='application/x-ndjson')
+        
+        ordered = [None] * len(items)
+        for _ in range(len(items)):
+            result = results.get()
+            ordered[result['index']] = result
+        return jsonify({'results': ordered, 'total': len(ordered)})
+        
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/initialize', methods=['POST'])
 def initialize_session():
     """Initialize a new session and get the first Eva message"""
@@ -444,22 +1599,21 @@ def initialize_session():
         data = request.json or {}
         session_id = data.get('session_id', str(uuid.uuid4()))
         
+        limited = check_rate_limit({session_id: 0})
+        if limited:
+            return limited
+        
         # Initialize conversation context for this session
         initialize_conversation_context(session_id)
         
         # Initial message for Eva (mejorado para ser más directo)
-        initial_message = "¡Hola! Soy Eva de Antares Innovate. ¿En qué puedo ayudarte con automatización, marketing o creatividad?"
+        initial_message = canned_responses["greeting_initialize"].text
         
         # Save to conversation context
         conversation_contexts[session_id]["messages"].append({"role": "assistant", "content": initial_message})
+        mark_session_changed(session_id)
         
-        result = {
-            'session_id': session_id,
-            'message': initial_message,
-            'context': conversation_contexts[session_id]["user_info"]
-        }
-        
-        return jsonify(result)
+        return canned_session_response("greeting_initialize", session_id)
         
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -473,8 +1627,13 @@ def get_context():
         
         if not session_id or session_id not in conversation_contexts:
             return jsonify({'error': 'Session not found'}), 404
+        
+        etag = f"ctx-{INSTANCE_ID}-{session_id}-{session_versions.get(session_id, 0)}"
+        cached = not_modified(etag)
+        if cached:
+            return cached
             
-        return jsonify(conversation_contexts[session_id])
+        return cacheable(jsonify(conversation_contexts[session_id]), etag, session_updated_at.get(session_id))
         
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -491,22 +1650,21 @@ def reset_conversation():
             
         session_id = data['session_id']
         
+        limited = check_rate_limit({session_id: 0})
+        if limited:
+            return limited
+        
         # Initialize a new conversation context
         initialize_conversation_context(session_id)
         
         # Initial message for Eva (más directo y enfocado en negocios)
-        initial_message = "¡Hola! Soy Eva de Antares Innovate. ¿En qué puedo ayudarte con automatización, marketing o creatividad para tu negocio?"
+        initial_message = canned_responses["greeting_reset"].text
         
         # Save to conversation context
         conversation_contexts[session_id]["messages"].append({"role": "assistant", "content": initial_message})
+        mark_session_changed(session_id)
         
-        result = {
-            'session_id': session_id,
-            'message': initial_message,
-            'context': conversation_contexts[session_id]["user_info"]
-        }
-        
-        return jsonify(result)
+        return canned_session_response("greeting_reset", session_id)
         
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -530,11 +1688,24 @@ def request_meeting():
         preferred_date = data.get('preferred_date')
         preferred_time = data.get('preferred_time')
         meeting_type = data.get('meeting_type', 'virtual')
+        if not isinstance(needs, list) or not all(isinstance(need, str) for need in needs):
+            return jsonify({'error': 'needs must be a list of strings'}), 400
+        
+        limited = check_rate_limit({session_id: 0}, action="meeting")
+        if limited:
+            return limited
         
         # Asegúrate de que el contexto de conversación existe
         if session_id not in conversation_contexts:
             initialize_conversation_context(session_id)
         
+        # Reservar el slot si la fecha y hora corresponden a uno ofrecido.
+        # Se reserva después de validar los datos y antes de tocar el
+        # contexto, para no dejar reservas huérfanas si algo falla.
+        slot_start = parse_slot_start(preferred_date, preferred_time)
+        if slot_start and not book_slot(slot_start, session_id):
+            return jsonify({'error': 'Slot not available'}), 409
+        
         # Actualizar información del contexto
         context = conversation_contexts[session_id]["user_info"]
         if name:
@@ -572,12 +1743,21 @@ def request_meeting():
         
         # Guardar respuesta en el historial
         conversation_contexts[session_id]["messages"].append({"role": "assistant", "content": confirmation_message})
+        mark_session_changed(session_id)
+        publish_event('meeting', {
+            'session_id': session_id,
+            'name': context["name"],
+            'preferred_day': context["preferred_day"],
+            'preferred_time': context["preferred_time"],
+            'slot_booked': slot_start is not None
+        })
         
         result = {
             'session_id': session_id,
             'message': confirmation_message,
             'context': conversation_contexts[session_id]["user_info"],
-            'meeting_requested': True
+            'meeting_requested': True,
+            'slot_booked': slot_start is not None
         }
         
         return jsonify(result)
@@ -589,67 +1769,79 @@ def request_meeting():
 @app.route('/api/config', methods=['GET', 'POST'])
 def handle_config():
     """Get or update configuration"""
-    global LOCAL_OLLAMA_URL, MODEL_NAME, EVA_CONTEXT
-    
     if request.method == 'GET':
-        return jsonify({
-            'ollama_url': LOCAL_OLLAMA_URL,
-            'model_name': MODEL_NAME,
-            'prompt_context': EVA_CONTEXT
-        })
+        config = current_config
+        etag = f"config-{INSTANCE_ID}-{config.version}"
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        return cacheable(jsonify({
+            'version': config.version,
+            'ollama_url': config.ollama_url,
+            'model_name': config.model_name,
+            'prompt_context': config.prompt_context,
+            'keywords': config.keywords,
+            'intent_mode': config.intent_mode
+        }), etag, config.updated_at)
     elif request.method == 'POST':
         try:
             data = request.json
             
-            if 'ollama_url' in data:
-                LOCAL_OLLAMA_URL = data['ollama_url']
-            if 'model_name' in data:
-                MODEL_NAME = data['model_name']
-            if 'prompt_context' in data:
-                EVA_CONTEXT = data['prompt_context']
+            if not data or not isinstance(data, dict):
+                return jsonify({'error': 'No configuration provided'}), 400
+            changes = {key: data[key] for key in CONFIG_FIELDS if key in data}
+            if not changes:
+                return jsonify({'error': f"No known configuration fields (expected: {', '.join(CONFIG_FIELDS)})"}), 400
+            try:
+                validate_config_changes(changes)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            
+            config = save_config(**changes)
                 
             return jsonify({
-                'ollama_url': LOCAL_OLLAMA_URL,
-                'model_name': MODEL_NAME,
-                'prompt_context': EVA_CONTEXT,
+                'version': config.version,
+                'ollama_url': config.ollama_url,
+                'model_name': config.model_name,
+                'prompt_context': config.prompt_context,
+                'keywords': config.keywords,
+                'intent_mode': config.intent_mode,
                 'status': 'updated'
             })
         except Exception as e:
-            return jsonify({'error': str(e)}), 1500
+            print(f"Error: {str(e)}")
+            return jsonify({'error': str(e)}), 500
 
 @app.route('/api/available_slots', methods=['GET'])
 def available_slots():
-    """Endpoint que devuelve slots disponibles para reuniones (simulados)"""
+    """Endpoint que devuelve slots disponibles para reuniones.
+
+    Acepta un rango opcional con `from` y `to` (YYYY-MM-DD, inclusivos). Por
+    defecto devuelve los próximos 7 días.
+    """
     try:
-        # Obtener la fecha actual
-        today = datetime.now()
+        today = datetime.now().date()
+        try:
+            start_day = datetime.strptime(request.args['from'], '%Y-%m-%d').date() if 'from' in request.args else today + timedelta(days=1)
+            end_day = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if 'to' in request.args else today + timedelta(days=SLOT_WINDOW_DAYS)
+        except ValueError:
+            return jsonify({'error': 'Invalid date, expected YYYY-MM-DD'}), 400
         
-        # Generar slots disponibles para los próximos 5 días laborables
-        available_slots = []
+        if end_day < start_day or (end_day - start_day).days > SLOT_MAX_RANGE_DAYS:
+            return jsonify({'error': f'Invalid range (max {SLOT_MAX_RANGE_DAYS} days)'}), 400
         
-        for i in range(1, 8):  # Próximos 7 días
-            current_date = today + timedelta(days=i)
-            
-            # Saltear fines de semana
-            if current_date.weekday() >= 5:  # 5=Sábado, 6=Domingo
-                continue
-                
-            # Generar slots de 1 hora entre 9am y 5pm
-            for hour in range(9, 17):
-                # Simular que algunos slots ya están ocupados
-                if (current_date.day + hour) % 3 != 0:  # Un patrón simple para que algunos slots estén ocupados
-                    slot = {
-                        'date': current_date.strftime('%Y-%m-%d'),
-                        'day': ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo'][current_date.weekday()],
-                        'time': f"{hour}:00",
-                        'end_time': f"{hour+1}:00",
-                        'available': True
-                    }
-                    available_slots.append(slot)
+        # El ETag cambia con cada reserva, con el rango pedido y con el día actual
+        refresh_bookings()
+        etag = f"slots-{bookings_id}-{availability_version}-{today}-{start_day}-{end_day}"
+        cached = not_modified(etag)
+        if cached:
+            return cached
         
-        return jsonify({
-            'slots': available_slots
-        })
+        return cacheable(jsonify({
+            'slots': get_available_slots(start_day, end_day),
+            'from': start_day.strftime('%Y-%m-%d'),
+            'to': end_day.strftime('%Y-%m-%d')
+        }), etag)
         
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -659,50 +1851,99 @@ def available_slots():
 def get_leads():
     """Endpoint para obtener los leads generados (para integración con CRM)"""
     try:
+        etag = f"leads-{INSTANCE_ID}-{contexts_version}"
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        
         # Extraer leads basados en conversaciones que han llegado a la etapa ready_for_meeting
         leads = []
         
-        for session_id, context in conversation_contexts.items():
+        # Copia de las sesiones: otros hilos del worker pueden crear sesiones mientras tanto
+        for session_id, context in list(conversation_contexts.items()):
             user_info = context["user_info"]
-            
-            # Solo considerar como leads aquellos que han mostrado interés en una reunión
-            if user_info["stage"] == "ready_for_meeting" or user_info["meeting_interest"]:
-                # Crear un objeto lead con la información disponible
-                lead = {
-                    'session_id': session_id,
-                    'name': user_info["name"] or "Desconocido",
-                    'email': user_info["email"] or None,
-                    'phone': user_info["phone"] or None,
-                    'business': user_info["business"] or None,
-                    'industry': user_info["industry"] or None,
-                    'needs': user_info["needs"],
-                    'meeting_preference': user_info["meeting_preference"] or "No especificado",
-                    'preferred_day': user_info["preferred_day"] or None,
-                    'preferred_time': user_info["preferred_time"] or None,
-                    'last_interaction': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'complete_info': bool(user_info["email"] or user_info["phone"])
-                }
-                
-                leads.append(lead)
+            if is_lead(user_info):
+                leads.append(build_lead(session_id, user_info))
         
-        return jsonify({
+        return cacheable(jsonify({
             'leads': leads,
-            'total': len(leads)
-        })
+            'total': len(leads),
+            'total_sessions': len(conversation_contexts)
+        }), etag, contexts_updated_at)
         
     except Exception as e:
         print(f"Error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/events', methods=['GET'])
+def admin_events():
+    """Server-sent events con los cambios de leads y sesiones para el panel"""
+    try:
+        resume_from = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        resume_from = 0
+    
+    subscriber = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+    with events_lock:
+        if len(event_subscribers) >= SSE_MAX_SUBSCRIBERS:
+            return jsonify({'error': 'Too many dashboards connected'}), 503, {'Retry-After': str(SSE_RETRY_AFTER_SECONDS)}
+        missed = [event for event in recent_events if event[0] > resume_from] if resume_from else []
+        event_subscribers.append(subscriber)
+        snapshot = (last_event_id, 'stats', json.dumps(get_stats()))
+    
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            for event in missed:
+                yield format_sse(event)
+            yield format_sse(snapshot)
+            while True:
+                try:
+                    event = subscriber.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield format_sse(event)
+        finally:
+            with events_lock:
+                if subscriber in event_subscribers:
+                    event_subscribers.remove(subscriber)
+    
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'ok',
         'api_version': '1.1.0',
-        'service': 'Eva - Asistente Virtual de Antares Innovate'
+        'service': 'Eva - Asistente Virtual de Antares Innovate',
+        'canned_responses': canned_stats,
+        'generation': generation_stats,
+        'startup': startup_report,
+        'rate_limit': rate_limit_stats,
+        'intent_mode': current_config.intent_mode,
+        'intent_model': {'examples': current_config.intent_model.examples, 'features': len(current_config.intent_model.weights)} if current_config.intent_model else None
     })
 
+@app.route('/api/canned_audio/<key>', methods=['GET'])
+def canned_audio(key):
+    """Audio precalculado de una respuesta fija (requiere EVA_CANNED_AUDIO=1)"""
+    canned = canned_responses.get(key)
+    if not canned or not canned.audio:
+        return jsonify({'error': 'Audio not available'}), 404
+    
+    etag = f"audio-{key}-{hashlib.md5(canned.audio).hexdigest()}"
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    return cacheable(app.response_class(canned.audio, mimetype='audio/mpeg'), etag)
+
 # Ruta básica para la raíz
 @app.route('/', methods=['GET'])
 def index():
@@ -713,10 +1954,8 @@ def index():
         'description': 'API para el chatbot Eva de Antares Innovate'
     })
 
-@app.route('/admin', methods=['GET'])
-def admin_panel():
-    """Panel de administración simplificado"""
-    html = """
+# El HTML del panel es estático: se construye una sola vez al importar el módulo
+ADMIN_HTML = """
     <!DOCTYPE html>
     <html lang="es">
     <head>
@@ -777,7 +2016,7 @@ def admin_panel():
                                         </tr>
                                     </thead>
                                     <tbody id="leads-body">
-                                        <tr>
+                                        <tr id="leads-loading">
                                             <td colspan="6" class="text-center">Cargando leads...</td>
                                         </tr>
                                     </tbody>
@@ -838,6 +2077,21 @@ def admin_panel():
                     </div>
                 </div>
             </div>
+            
+            <div class="row">
+                <div class="col-12">
+                    <div class="card">
+                        <div class="card-header">
+                            Actividad Reciente
+                        </div>
+                        <div class="card-body">
+                            <ul class="list-unstyled mb-0" id="activity-list">
+                                <li id="activity-empty" class="text-muted">Sin actividad todavía</li>
+                            </ul>
+                        </div>
+                    </div>
+                </div>
+            </div>
         </div>
         
         <script src="https://code.jquery.com/jquery-3.6.0.min.js"></script>
@@ -845,6 +2099,8 @@ def admin_panel():
         <script>
             // Cargar datos al iniciar
             document.addEventListener('DOMContentLoaded', function() {
+                // Suscribirse antes de cargar para no perder cambios intermedios
+                subscribeEvents();
                 loadLeads();
                 loadConfig();
                 
@@ -855,41 +2111,112 @@ def admin_panel():
                 });
             });
             
-            // Cargar leads
+            // Cargar leads (una sola vez; luego se actualizan por eventos)
             function loadLeads() {
                 fetch('/api/leads')
                     .then(response => response.json())
                     .then(data => {
-                        const leadsTable = document.getElementById('leads-body');
-                        document.getElementById('total-leads').textContent = data.total;
-                        document.getElementById('total-conversations').textContent = Object.keys(data.leads).length;
-                        
-                        if (data.leads.length === 0) {
-                            leadsTable.innerHTML = '<tr><td colspan="6" class="text-center">No hay leads generados aún</td></tr>';
-                            return;
-                        }
-                        
-                        leadsTable.innerHTML = '';
-                        data.leads.forEach(lead => {
-                            const needsBadges = lead.needs.map(need => 
-                                `<span class="badge badge-needs">${need}</span>`
-                            ).join(' ');
-                            
-                            leadsTable.innerHTML += `
-                                <tr>
-                                    <td>${lead.name}</td>
-                                    <td>${lead.email || '-'}</td>
-                                    <td>${lead.phone || '-'}</td>
-                                    <td>${lead.business || '-'}</td>
-                                    <td>${needsBadges || '-'}</td>
-                                    <td>${lead.last_interaction}</td>
-                                </tr>
-                            `;
-                        });
+                        updateStats({sessions: data.total_sessions, leads: data.total});
+                        data.leads.forEach(upsertLead);
+                        showEmptyState();
                     })
                     .catch(error => console.error('Error:', error));
             }
             
+            // Recibir cambios en vivo del servidor
+            function subscribeEvents() {
+                const events = new EventSource('/api/events');
+                events.addEventListener('lead', e => {
+                    upsertLead(JSON.parse(e.data).lead);
+                    showEmptyState();
+                });
+                events.addEventListener('lead_removed', e => {
+                    const row = document.getElementById('lead-' + JSON.parse(e.data).session_id);
+                    if (row) row.remove();
+                    showEmptyState();
+                });
+                events.addEventListener('stats', e => updateStats(JSON.parse(e.data)));
+                events.addEventListener('stage', e => {
+                    const change = JSON.parse(e.data);
+                    addActivity(`Sesión ${change.session_id.slice(0, 8)}: ${change.from} → ${change.to}`);
+                });
+                events.addEventListener('meeting', e => {
+                    const meeting = JSON.parse(e.data);
+                    const when = [meeting.preferred_day, meeting.preferred_time].filter(Boolean).join(' ') || 'sin fecha';
+                    addActivity(`Reunión solicitada por ${meeting.name || 'Desconocido'} (${when})` +
+                                (meeting.slot_booked ? ', slot reservado' : ''));
+                });
+                events.onerror = () => {
+                    // El servidor rechazó la conexión (demasiados paneles): reintentar más tarde
+                    if (events.readyState === EventSource.CLOSED) {
+                        setTimeout(() => { subscribeEvents(); loadLeads(); }, 30000);
+                    }
+                };
+            }
+            
+            // Últimos cambios de etapa y solicitudes de reunión (máximo 20)
+            function addActivity(text) {
+                const list = document.getElementById('activity-list');
+                const empty = document.getElementById('activity-empty');
+                if (empty) empty.remove();
+                const item = document.createElement('li');
+                item.textContent = new Date().toLocaleTimeString() + ' · ' + text;
+                list.prepend(item);
+                while (list.children.length > 20) list.lastChild.remove();
+            }
+            
+            function updateStats(stats) {
+                document.getElementById('total-conversations').textContent = stats.sessions;
+                document.getElementById('total-leads').textContent = stats.leads;
+            }
+            
+            function showEmptyState() {
+                const leadsTable = document.getElementById('leads-body');
+                const empty = document.getElementById('leads-empty');
+                const hasLeads = leadsTable.querySelector('tr[data-lead]') !== null;
+                if (hasLeads && empty) {
+                    empty.remove();
+                } else if (!hasLeads && !empty) {
+                    leadsTable.innerHTML = '<tr id="leads-empty"><td colspan="6" class="text-center">No hay leads generados aún</td></tr>';
+                }
+            }
+            
+            // Insertar o actualizar la fila de un lead sin reconstruir la tabla
+            function upsertLead(lead) {
+                const leadsTable = document.getElementById('leads-body');
+                const loading = document.getElementById('leads-loading');
+                if (loading) loading.remove();
+                
+                let row = document.getElementById('lead-' + lead.session_id);
+                if (!row) {
+                    row = document.createElement('tr');
+                    row.id = 'lead-' + lead.session_id;
+                    row.dataset.lead = '1';
+                    leadsTable.prepend(row);
+                }
+                row.replaceChildren();
+                
+                [lead.name, lead.email || '-', lead.phone || '-', lead.business || '-'].forEach(value => {
+                    const cell = document.createElement('td');
+                    cell.textContent = value;
+                    row.appendChild(cell);
+                });
+                
+                const needsCell = document.createElement('td');
+                lead.needs.forEach(need => {
+                    const badge = document.createElement('span');
+                    badge.className = 'badge badge-needs';
+                    badge.textContent = need;
+                    needsCell.appendChild(badge);
+                });
+                if (!lead.needs.length) needsCell.textContent = '-';
+                row.appendChild(needsCell);
+                
+                const lastCell = document.createElement('td');
+                lastCell.textContent = lead.last_interaction;
+                row.appendChild(lastCell);
+            }
+            
             // Cargar configuración
             function loadConfig() {
                 fetch('/api/config')
@@ -929,10 +2256,415 @@ def admin_panel():
     </body>
     </html>
     """
-    return html
+ADMIN_ETAG = "admin-" + hashlib.md5(ADMIN_HTML.encode('utf-8')).hexdigest()
+
+@app.route('/admin', methods=['GET'])
+def admin_panel():
+    """Panel de administración simplificado"""
+    cached = not_modified(ADMIN_ETAG)
+    if cached:
+        return cached
+    return cacheable(app.response_class(ADMIN_HTML, mimetype='text/html'), ADMIN_ETAG)
+
+@app.after_request
+def compress_response(response):
+    """Compress large responses with gzip when the client accepts it"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    if response.content_length is None or response.content_length < COMPRESS_MIN_SIZE:
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.headers.get('Accept-Encoding', '').lower():
+        return response
+    
+    response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def load_conversations(path):
+    """Load recorded conversations from a JSONL file.
+
+    Each line is one conversation in the /api/context format: {"session_id",
+    "messages", "user_info"}. Messages can be {"role", "content"} dicts or
+    plain strings (user turns); "user_info" is optional.
+    """
+    conversations = []
+    with open(path, encoding='utf-8') as jsonl_file:
+        for line_number, line in enumerate(jsonl_file, 1):
+            if not line.strip():
+                continue
+            try:
+                conversations.append(parse_conversation(line, f"{path}:{line_number}"))
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: {str(e)}")
+    return conversations
+
+def parse_conversation(line, location):
+    """Parse one JSONL conversation record (see load_conversations)"""
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("se esperaba un objeto JSON")
+    messages = [
+        {"role": "user", "content": message} if isinstance(message, str) else message
+        for message in record.get("messages", [])
+    ]
+    return {
+        "session_id": record.get("session_id") or f"replay-{location}",
+        "messages": messages,
+        "user_info": record.get("user_info"),
+        "last_interaction": record.get("last_interaction")
+    }
+
+def replay_conversation(conversation, timings=None):
+    """Run the non-LLM pipeline (extraction + prompt) over a recorded conversation.
+
+    Recorded assistant turns are appended to the history as-is so that the
+    prompt sees the same message counts as in production. Returns user_info.
+    """
+    session_id = conversation["session_id"]
+    initialize_conversation_context(session_id)
+    history = conversation_contexts[session_id]["messages"]
+    started = time.perf_counter()
+    user_messages = [message["content"] for message in conversation["messages"] if message.get("role") == "user"]
+    batch_intents = iter(detect_intents_batch(user_messages))
+    if timings is not None:
+        timings["extraction"] += time.perf_counter() - started
+    for message in conversation["messages"]:
+        if message.get("role") != "user":
+            history.append(message)
+            continue
+        started = time.perf_counter()
+        update_conversation_context(message["content"], session_id, next(batch_intents))
+        extracted = time.perf_counter()
+        build_custom_prompt(session_id)
+        if timings is not None:
+            timings["extraction"] += extracted - started
+            timings["prompt"] += time.perf_counter() - extracted
+        history.append(message)
+    return conversation_contexts.pop(session_id)["user_info"]
+
+def diff_user_info(old, new):
+    """Fields recorded in `old` whose value is different in `new`"""
+    return {field: (old[field], new.get(field)) for field in sorted(old) if old[field] != new.get(field)}
+
+@app.cli.command("replay")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--repeat", default=5, show_default=True, help="Pasadas completas para medir el rendimiento.")
+@click.option("--allocations/--no-allocations", default=True, show_default=True, help="Medir memoria con tracemalloc (pasada aparte).")
+@click.option("--output", type=click.Path(dir_okay=False), help="Guardar el user_info resultante en JSONL.")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), help="Comparar con un --output de otra versión.")
+def replay_command(path, repeat, allocations, output, baseline):
+    """Replay recorded conversations through extraction and prompt building.
+
+    Reports per-stage throughput, allocations and user_info differences
+    against the recorded values or a previous --output.
+    """
+    try:
+        conversations = load_conversations(path)
+        if baseline:
+            expected = {record["session_id"]: record["user_info"] for record in load_conversations(baseline) if record["user_info"]}
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    user_messages = sum(1 for conversation in conversations for message in conversation["messages"] if message.get("role") == "user")
+    if not user_messages:
+        raise click.ClickException("No hay mensajes de usuario para reproducir")
+    
+    timings = {"extraction": 0.0, "prompt": 0.0}
+    results = {}
+    for _ in range(max(1, repeat)):
+        for conversation in conversations:
+            results[conversation["session_id"]] = replay_conversation(conversation, timings)
+    
+    processed = user_messages * max(1, repeat)
+    click.echo(f"{len(conversations)} conversaciones, {user_messages} mensajes de usuario, {repeat} pasadas")
+    for stage, elapsed in timings.items():
+        rate = processed / elapsed if elapsed else float("inf")
+        click.echo(f"  {stage:<10} {rate:>12,.0f} msg/s  ({elapsed * 1e6 / processed:.1f} µs/msg)")
+    total = sum(timings.values())
+    click.echo(f"  {'total':<10} {processed / total if total else float('inf'):>12,.0f} msg/s")
+    
+    if allocations:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for conversation in conversations:
+            replay_conversation(conversation)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename") if stat.size_diff > 0)
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+        click.echo(f"  memoria    pico {peak / 1024:.1f} KiB, retenido {allocated / 1024:.1f} KiB en {blocks} bloques por pasada")
+    
+    # Diferencias con lo grabado o con la versión anterior
+    if not baseline:
+        expected = {conversation["session_id"]: conversation["user_info"] for conversation in conversations if conversation["user_info"]}
+    changed = 0
+    for session_id, user_info in results.items():
+        if session_id not in expected:
+            continue
+        differences = diff_user_info(expected[session_id], user_info)
+        if differences:
+            changed += 1
+            click.echo(f"~ {session_id}")
+            for field, (old, new) in differences.items():
+                click.echo(f"    {field}: {old!r} -> {new!r}")
+    if expected:
+        click.echo(f"{changed} de {len(expected)} sesiones con user_info distinto")
+    
+    if output:
+        with open(output, 'w', encoding='utf-8') as output_file:
+            for session_id, user_info in results.items():
+                output_file.write(json.dumps({"session_id": session_id, "user_info": user_info}, ensure_ascii=False) + "\n")
+        click.echo(f"user_info guardado en {output}")
+
+def rescore_chunk(lines):
+    """Recompute user_info, stage and lead status for a chunk of archived lines.
+
+    Runs in a worker process. Returns (records, messages, errors).
+    """
+    records = []
+    messages = 0
+    errors = []
+    for location, line in lines:
+        try:
+            conversation = parse_conversation(line, location)
+            user_info = replay_conversation(conversation)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            errors.append(f"{location}: {str(e)}")
+            continue
+        messages += sum(1 for message in conversation["messages"] if message.get("role") == "user")
+        lead = None
+        if is_lead(user_info):
+            lead = build_lead(conversation["session_id"], user_info)
+            lead["last_interaction"] = conversation["last_interaction"]
+        records.append({
+            "session_id": conversation["session_id"],
+            "stage": user_info["stage"],
+            "is_lead": lead is not None,
+            "lead": lead,
+            "user_info": user_info
+        })
+    return records, messages, errors
+
+def init_rescore_worker(intent_mode):
+    """Pool initializer: apply `flask rescore --intent-mode` in each worker process"""
+    global current_config
+
+    if intent_mode:
+        current_config = current_config._replace(intent_mode=intent_mode)
+
+def read_chunks(path, chunk_size):
+    """Stream (location, line) chunks from an archive without loading it whole"""
+    chunk = []
+    with open(path, encoding='utf-8') as jsonl_file:
+        for line_number, line in enumerate(jsonl_file, 1):
+            if not line.strip():
+                continue
+            chunk.append((f"{path}:{line_number}", line))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+@app.cli.command("rescore")
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output", type=click.Path(dir_okay=False))
+@click.option("--workers", default=os.cpu_count() or 1, show_default=True, help="Procesos en paralelo.")
+@click.option("--chunk-size", default=500, show_default=True, help="Conversaciones por tarea.")
+@click.option("--leads-only", is_flag=True, help="Escribir solo las sesiones que resultan ser leads.")
+@click.option("--intent-mode", type=click.Choice(INTENT_MODES), help="Detectar la intención con el modelo o con las palabras clave (por defecto, la configuración).")
+def rescore_command(archive, output, workers, chunk_size, leads_only, intent_mode):
+    """Re-score archived conversations with the current keyword tables and stage logic.
+
+    ARCHIVE uses the same JSONL format as `flask replay`; the recomputed
+    records are written to OUTPUT as JSONL. Uses the configuration in
+    EVA_CONFIG_FILE and the model trained from INTENT_TRAINING_FILE, so new
+    keyword tables or training data can be tried before publishing. The
+    "meeting" and "price" tables only apply with --intent-mode keywords.
+    """
+    workers = max(1, workers)
+    started = time.perf_counter()
+    totals = {"conversations": 0, "messages": 0, "leads": 0, "errors": 0}
+    last_report = started
+    
+    def collect(futures, output_file):
+        nonlocal last_report
+        for future in futures:
+            records, messages, errors = future.result()
+            totals["conversations"] += len(records)
+            totals["messages"] += messages
+            totals["errors"] += len(errors)
+            for error in errors:
+                click.echo(f"Error: {error}", err=True)
+            lines = []
+            for record in records:
+                if record["is_lead"]:
+                    totals["leads"] += 1
+                elif leads_only:
+                    continue
+                lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+            output_file.writelines(lines)
+        
+        now = time.perf_counter()
+        if now - last_report >= 1:
+            last_report = now
+            click.echo(f"{totals['conversations']:,} conversaciones, {totals['messages']:,} mensajes "
+                       f"({totals['messages'] / (now - started):,.0f} msg/s)", err=True)
+    
+    with open(output, 'w', encoding='utf-8') as output_file, ProcessPoolExecutor(max_workers=workers, initializer=init_rescore_worker, initargs=(intent_mode,)) as executor:
+        pending = set()
+        for chunk in read_chunks(archive, chunk_size):
+            pending.add(executor.submit(rescore_chunk, chunk))
+            # Limitar las tareas en vuelo para no cargar todo el archivo en memoria
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done, output_file)
+        collect(pending, output_file)
+    
+    elapsed = time.perf_counter() - started
+    click.echo(f"{totals['conversations']:,} conversaciones y {totals['messages']:,} mensajes en {elapsed:.1f} s "
+               f"({totals['messages'] / elapsed if elapsed else 0:,.0f} msg/s, {workers} procesos); "
+               f"{totals['leads']:,} leads, {totals['errors']} errores")
+
+def warm_up_ollama():
+    """Load the model in Ollama and open this worker's connection before the first chat"""
+    config = current_config
+    started = time.perf_counter()
+    try:
+        # Una petición sin mensajes solo carga el modelo y renueva keep_alive
+        response = ollama_http.post(config.ollama_url, json={
+            "model": config.model_name,
+            "messages": [],
+            "keep_alive": OLLAMA_KEEP_ALIVE
+        }, timeout=OLLAMA_WARMUP_TIMEOUT)
+        response.raise_for_status()
+        startup_report["warmup_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        print(f"Modelo {config.model_name} precargado en {startup_report['warmup_ms']} ms")
+    except requests.exceptions.RequestException as e:
+        startup_report["warmup_error"] = str(e)
+        print(f"No se pudo precargar el modelo: {str(e)}")
+
+def start_worker():
+    """Per-process startup: config watcher, fresh HTTP connection and model warm-up.
+
+    Only runs when serving: from gunicorn's post_fork hook, from __main__, or
+    on the first request otherwise. Threads and sockets do not survive a
+    fork, so it runs once in each worker process.
+    """
+    global ollama_http, INSTANCE_ID, worker_started
+
+    with worker_start_lock:
+        if worker_started:
+            return
+        worker_started = True
+        
+        started = time.perf_counter()
+        INSTANCE_ID = uuid.uuid4().hex  # Los workers no comparten el del maestro
+        ollama_http = requests.Session()
+        Thread(target=watch_config_file, daemon=True).start()
+        if OLLAMA_WARMUP:
+            Thread(target=warm_up_ollama, daemon=True).start()
+        if CANNED_AUDIO_ENABLED and not DEFER_WORKER_START:
+            Thread(target=synthesize_canned_audio, daemon=True).start()
+        startup_report["worker_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        startup_report["pid"] = os.getpid()
+
+@app.before_request
+def ensure_worker_started():
+    """Start the worker on the first request if no server hook did it"""
+    if not worker_started:
+        start_worker()
+
+mark_startup("routes")
+startup_report["total_ms"] = round((time.perf_counter() - STARTUP_STARTED) * 1000, 1)
+print(f"Eva cargada en {startup_report['total_ms']} ms: {startup_report}")
+
+# Casos que no están en los datos de entrenamiento y que el modelo debe
+# acertar antes de publicarse (presentaciones, plataformas, preguntas reales)
+INTENT_CONTROL_CASES = [
+    ("me llamo Roberto", set()),
+    ("mi nombre es Julián Restrepo", set()),
+    ("soy Carolina, tengo un spa", set()),
+    ("desarrollamos apps para ios", set()),
+    ("tengo una tienda en android y ios", set()),
+    ("quiero una web para mi hotel", set()),
+    ("¿cuándo nos podemos reunir?", {"meeting"}),
+    ("me llamo Juan, ¿agendamos una llamada?", {"meeting"}),
+    ("¿qué vale una app para ios?", {"price"}),
+    ("¿cuánto me costaría el branding?", {"price"})
+]
+
+@app.cli.command("intents")
+@click.option("--data", "data_path", default=INTENT_TRAINING_FILE, show_default=True, type=click.Path(exists=True, dir_okay=False), help="Mensajes etiquetados (JSONL).")
+@click.option("--folds", default=5, show_default=True, help="Particiones para la validación cruzada.")
+@click.option("--repeat", default=200, show_default=True, help="Pasadas para medir el rendimiento.")
+@click.option("--save", is_flag=True, help="Entrenar con todos los ejemplos y guardar los pesos en INTENT_MODEL_FILE.")
+def intents_command(data_path, folds, repeat, save):
+    """Compare the intent classifier with the keyword rules and optionally save it.
+
+    Reports cross-validated accuracy and false positives per intent, results
+    on INTENT_CONTROL_CASES, and classification throughput for the model
+    (per message and batched) and the rules. With --save, the model trained
+    on every example is written to INTENT_MODEL_FILE, which running workers
+    pick up within CONFIG_POLL_SECONDS.
+    """
+    examples = load_intent_examples(data_path)
+    if len(examples) < folds:
+        raise click.ClickException("No hay suficientes ejemplos etiquetados")
+    shuffled = list(examples)
+    random.Random(1).shuffle(shuffled)
+    extractors = current_config.extractors
+    
+    results = {"modelo": [], "reglas": []}
+    for fold in range(folds):
+        test = shuffled[fold::folds]
+        train = [example for index, example in enumerate(shuffled) if index % folds != fold]
+        model = train_intent_model(train)
+        for text, intents in test:
+            results["modelo"].append((intents, classify_intents(text, model)))
+            results["reglas"].append((intents, rule_intents(text, extractors)))
+    
+    click.echo(f"{len(examples)} ejemplos, validación cruzada en {folds} particiones")
+    for name, pairs in results.items():
+        accuracy = sum(expected == predicted for expected, predicted in pairs) / len(pairs)
+        details = []
+        for label in INTENT_LABELS:
+            false_positives = sum(label in predicted and label not in expected for expected, predicted in pairs)
+            false_negatives = sum(label in expected and label not in predicted for expected, predicted in pairs)
+            details.append(f"{label}: {false_positives} FP / {false_negatives} FN")
+        click.echo(f"  {name:<7} exactitud {accuracy:6.1%}   " + ", ".join(details))
+    
+    model = train_intent_model(examples)
+    for name, classify in (("modelo", lambda text: classify_intents(text, model)), ("reglas", lambda text: rule_intents(text, extractors))):
+        failed = [text for text, intents in INTENT_CONTROL_CASES if classify(text) != intents]
+        click.echo(f"  {name:<7} casos de control {len(INTENT_CONTROL_CASES) - len(failed)}/{len(INTENT_CONTROL_CASES)}"
+                   + (f"   fallan: {', '.join(failed)}" if failed else ""))
+    
+    texts = [text for text, _ in examples]
+    benchmarks = (
+        ("modelo", lambda: [classify_intents(text, model) for text in texts]),
+        ("lote", lambda: classify_intents_batch(texts, model)),
+        ("reglas", lambda: [rule_intents(text, extractors) for text in texts])
+    )
+    for name, classify in benchmarks:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            classify()
+        elapsed = time.perf_counter() - started
+        processed = len(texts) * repeat
+        click.echo(f"  {name:<7} {processed / elapsed:>10,.0f} msg/s ({elapsed * 1e6 / processed:.1f} µs/msg)")
+    
+    if save:
+        save_intent_model(model, INTENT_MODEL_FILE)
+        click.echo(f"Modelo guardado en {INTENT_MODEL_FILE} ({len(model.weights):,} n-gramas)")
 
 if __name__ == "__main__":
     # Obtener puerto de las variables de entorno o usar 5000 por defecto
     port = int(os.environ.get("PORT", 5000))
+    # Hilos del worker: vigilancia de la configuración y precarga del modelo
+    start_worker()
     # Usar host 0.0.0.0 para que la aplicación sea accesible desde fuera del contenedor
     app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
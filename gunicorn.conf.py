@@ -0,0 +1,22 @@
+# Configuración de gunicorn para producción
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Hilos por worker. Cada stream de /api/events ocupa uno mientras está
+# abierto, así que como mucho una cuarta parte se reserva para los paneles
+# y el resto queda siempre libre para /api/chat.
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+os.environ.setdefault("EVA_SSE_MAX_SUBSCRIBERS", str(max(1, threads // 4)))
+
+# La app se importa una sola vez en el proceso maestro (configuración, tablas
+# precalculadas, expresiones compiladas y HTML del panel) y los workers la
+# heredan al hacer fork. Cada worker inicia sus hilos y su conexión a Ollama
+# después del fork.
+preload_app = True
+os.environ["EVA_DEFER_WORKER_START"] = "1"
+
+
+def post_fork(server, worker):
+    import app
+    app.start_worker()